@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+'''
+In-process index of the address doctypes for the address and street
+endpoints.
+
+Answers the same questions as the address and street _msearch queries
+with dict lookups and a binary search, so the highest volume exact
+lookups don't need a round trip to Elasticsearch.
+'''
+from bisect import bisect_right
+import logging
+
+from geocoder import scroll
+
+# Addresses of each kind on a street, like the size of the street query
+STREET_SIZE = 10
+
+
+class Street(object):
+    '''Addresses of one street in one city, sorted by house number.'''
+    def __init__(self):
+        self.addresses = []
+        self.numbers = []
+        # Longest osoitenumero..osoitenumero2 range on this street,
+        # which bounds how far back the range search needs to look
+        self.max_span = 0
+
+    def add(self, address):
+        self.addresses.append(address)
+        self.max_span = max(self.max_span,
+                            address['osoitenumero2'] - address['osoitenumero'])
+
+    def finalize(self):
+        self.addresses.sort(key=lambda a: (a['osoitenumero'],
+                                           a['kiinteiston_jakokirjain']))
+        self.numbers = [a['osoitenumero'] for a in self.addresses]
+
+    def find(self, number, divisor, left_side):
+        '''
+        Addresses with the given number and divisor char, or if there's
+        no divisor, addresses whose number range on the given side
+        of the street includes the number.
+        '''
+        end = bisect_right(self.numbers, number)
+        if divisor:
+            found = []
+            for address in reversed(self.addresses[:end]):
+                if address['osoitenumero'] != number:
+                    break
+                if address['kiinteiston_jakokirjain'].lower() == divisor:
+                    found.append(address)
+            return found[::-1]
+        start = bisect_right(self.numbers, number - self.max_span - 1)
+        return [a for a in self.addresses[start:end]
+                if a['osoitenumero2'] >= number and a['left_side'] == left_side]
+
+
+class AddressIndex(object):
+    '''
+    HRI addresses indexed by every combination of lowercased Finnish
+    and Swedish city and street name, and OSM addresses by lowercased
+    municipality and street name.
+    '''
+    def __init__(self):
+        self.streets = {}
+        self.osm = {}
+
+    def add(self, address):
+        '''Add an address document from the address doctype.'''
+        for city in {address['kaupunki'].lower(), address['staden'].lower()}:
+            for street in {address['katunimi'].lower(), address['gatan'].lower()}:
+                self.streets.setdefault((city, street), Street()).add(address)
+
+    def add_osm(self, address):
+        '''Add an address document from the osm_address doctype.'''
+        self.osm.setdefault(((address['municipality'] or '').lower(),
+                             address['street']), []).append(address)
+
+    def finalize(self):
+        '''Sort the streets after all addresses have been added.'''
+        for street in self.streets.values():
+            street.finalize()
+
+    def _osm_street(self, city, streetname):
+        # XXX Title case doesn't work for "Ida Aalbergin tie",
+        #     but this mirrors the ES query exactly
+        return self.osm.get((city.lower(), streetname.title()), [])
+
+    def address(self, city, streetname, streetnumber, number, divisor):
+        '''
+        HRI and OSM address documents matching the address, like the
+        two responses of the address _msearch.
+        '''
+        number = int(number)
+        street = self.streets.get((city.lower(), streetname.lower()))
+        if street is None:
+            hri = []
+        else:
+            # In Finland, when looking from the beginning of a street to end,
+            # right side always has odd and left side even numbers
+            hri = street.find(number, divisor.lower(), number % 2 == 0)
+        osm = [a for a in self._osm_street(city, streetname)
+               if a['number'] == streetnumber]
+        return hri, osm
+
+    def street(self, city, streetname):
+        '''
+        HRI and OSM address documents on a street, at most STREET_SIZE
+        of each with the lowest numbers, as the street _msearch returns
+        at most that many.
+        '''
+        street = self.streets.get((city.lower(), streetname.lower()))
+        return ((street.addresses if street else [])[:STREET_SIZE],
+                self._osm_street(city, streetname)[:STREET_SIZE])
+
+
+def load(es_url):
+    '''Build an AddressIndex from the address doctypes in Elasticsearch.'''
+    index = AddressIndex()
+    for address in scroll.documents(es_url, 'address'):
+        index.add(address)
+    for address in scroll.documents(es_url, 'osm_address'):
+        index.add_osm(address)
+    index.finalize()
+    logging.info("Indexed %i streets and %i OSM streets",
+                 len(index.streets), len(index.osm))
+    return index
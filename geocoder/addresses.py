@@ -23,7 +23,7 @@ import click
 import pyelasticsearch
 from pyproj import Proj, transform
 
-from geocoder.utils import ES, INDEX, prepare_es
+from geocoder.utils import ES, INDEX, NGRAM_FIELD, prepare_es
 
 # ETRS89 / GK25FIN. Note it is NOT ETRS89 / ETRS-GK25FIN, which is EPSG:3132
 in_projision = Proj(init='epsg:3879')
@@ -79,12 +79,14 @@ def main(cvsfilename):
                           "lower": {
                               "type": "string",
                               "analyzer": "myAnalyzer"}}}
+    infix_mapping = dict(street_mapping, fields=dict(street_mapping['fields'],
+                                                     ngram=NGRAM_FIELD))
     prepare_es(((DOCTYPE,
                  {"properties": {
                      "location": {
                          "type": "geo_point"},
-                     "katunimi": street_mapping,
-                     "gatan": street_mapping,
+                     "katunimi": infix_mapping,
+                     "gatan": infix_mapping,
                      "kaupunki": street_mapping,
                      "staden": street_mapping,
                      "osoitenumero": {"type": "long"},
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+'''
+Admission control for requests that query Elasticsearch.
+
+Every endpoint may have at most ``limit`` queries in ES at a time, and
+all endpoints together at most ``total``. Requests over the limits wait
+in a bounded queue of their endpoint, and when there's room, the waiting
+request of the highest priority endpoint is let in first. Requests that
+don't fit in the queue, or wait too long, are rejected with a 503, so an
+overloaded ES sheds load instead of making every request slow. Requests
+whose client goes away leave the queue at once.
+'''
+from datetime import timedelta
+import heapq
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.web import HTTPError
+
+from geocoder.es_client import Cancelled, unless_cancelled
+
+# Waiting requests per endpoint
+QUEUE_SIZE = 100
+# Queries in ES at a time from all endpoints together
+TOTAL = 100
+# Seconds a request may wait in the queue
+TIMEOUT = 5.0
+# Seconds after which a rejected client should try again
+RETRY_AFTER = 1
+# Lower number is higher priority. Cheap exact lookups come first,
+# expensive geo sorts and wildcards later.
+PRIORITIES = {'address': 0, 'interpolate': 1, 'reverse': 2, 'suggest': 3, 'batch': 4}
+
+
+class Overloaded(HTTPError):
+    '''503 for a request that was not admitted.'''
+    def __init__(self, retry_after, reason):
+        super().__init__(503, reason)
+        self.retry_after = retry_after
+
+
+class Endpoint(object):
+    def __init__(self, name, priority, limit=None, queue_size=QUEUE_SIZE):
+        self.name = name
+        self.priority = priority
+        self.limit = limit
+        self.queue_size = queue_size
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.queue_full = 0
+        self.timeouts = 0
+        # Requests whose client went away while waiting
+        self.cancelled = 0
+
+
+class AdmissionControl(object):
+    '''Concurrency limits and priority queues for the ES backed endpoints.'''
+    def __init__(self, total=TOTAL, timeout=TIMEOUT, retry_after=RETRY_AFTER):
+        self.total = total
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.active = 0
+        self.endpoints = {name: Endpoint(name, priority)
+                          for name, priority in PRIORITIES.items()}
+        # (priority, arrival, endpoint, future) of the waiting requests
+        self._waiters = []
+        self._arrivals = 0
+
+    def configure(self, total=TOTAL, timeout=TIMEOUT, retry_after=RETRY_AFTER,
+                  limits=()):
+        '''
+        Change the settings. limits are (endpoint name, limit, queue size)
+        tuples, where a limit of None means no limit of its own.
+        '''
+        self.__init__(total, timeout, retry_after)
+        for name, limit, queue_size in limits:
+            self.endpoints[name].limit = limit
+            self.endpoints[name].queue_size = queue_size
+
+    def _has_room(self, endpoint):
+        return ((not self.total or self.active < self.total) and
+                (endpoint.limit is None or endpoint.active < endpoint.limit))
+
+    def _admit(self, endpoint):
+        self.active += 1
+        endpoint.active += 1
+        endpoint.admitted += 1
+
+    async def acquire(self, name, cancelled=None):
+        '''
+        Wait until a request to the endpoint may query ES. Raises
+        Overloaded if the queue is full or the wait takes too long, and
+        es_client.Cancelled if the cancelled Future resolves while waiting.
+        Every successful acquire must be followed by a release.
+        '''
+        endpoint = self.endpoints[name]
+        if self._has_room(endpoint):
+            self._admit(endpoint)
+            return
+        if endpoint.waiting >= endpoint.queue_size:
+            endpoint.queue_full += 1
+            raise Overloaded(self.retry_after, "Too many requests waiting")
+        future = Future()
+        self._arrivals += 1
+        heapq.heappush(self._waiters,
+                       (endpoint.priority, self._arrivals, endpoint, future))
+        endpoint.waiting += 1
+        waiting = unless_cancelled(future, cancelled)
+        try:
+            if self.timeout:
+                await gen.with_timeout(timedelta(seconds=self.timeout), waiting)
+            else:
+                await waiting
+        except (gen.TimeoutError, Cancelled) as e:
+            # Admitted after giving up, but before this coroutine resumed
+            if future.done():
+                if isinstance(e, Cancelled):
+                    self.release(name)
+                    raise
+                return
+            endpoint.waiting -= 1
+            # Leave it in the heap, it will be skipped as done
+            future.set_result(False)
+            if isinstance(e, Cancelled):
+                endpoint.cancelled += 1
+                raise
+            endpoint.timeouts += 1
+            raise Overloaded(self.retry_after, "Waited too long")
+
+    def release(self, name):
+        '''A request to the endpoint is done with ES.'''
+        endpoint = self.endpoints[name]
+        self.active -= 1
+        endpoint.active -= 1
+        self._wake()
+
+    def _wake(self):
+        '''Admit the waiting requests that fit in, highest priority first.'''
+        blocked = []
+        while self._waiters and (not self.total or self.active < self.total):
+            waiter = heapq.heappop(self._waiters)
+            _, _, endpoint, future = waiter
+            if future.done():
+                continue
+            if self._has_room(endpoint):
+                endpoint.waiting -= 1
+                self._admit(endpoint)
+                future.set_result(True)
+            else:
+                blocked.append(waiter)
+        for waiter in blocked:
+            heapq.heappush(self._waiters, waiter)
+
+    def stats(self):
+        '''Counters and limits of every endpoint.'''
+        return {name: {'priority': e.priority,
+                       'limit': e.limit,
+                       'queue_size': e.queue_size,
+                       'active': e.active,
+                       'waiting': e.waiting,
+                       'admitted': e.admitted,
+                       'queue_full': e.queue_full,
+                       'timeouts': e.timeouts,
+                       'cancelled': e.cancelled}
+                for name, e in self.endpoints.items()}
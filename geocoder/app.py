@@ -1,31 +1,160 @@
 #!/usr/bin/env python3
 # pylint: disable=abstract-method,arguments-differ
+import asyncio
+from datetime import timedelta
+from hashlib import sha1
 import json
 import logging
+from math import isfinite
+import os
 import re
+from time import monotonic
 
 import click
-from jinja2 import Template
+import numpy as np
 from shapely.geometry import LineString
-from tornado.httpclient import AsyncHTTPClient
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.httpclient import HTTPError as HTTPClientError
+from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
-from tornado.web import RequestHandler, Application, URLSpec, asynchronous, HTTPError, StaticFileHandler
-
+from tornado.log import access_log
+from tornado.netutil import bind_sockets
+from tornado.platform.asyncio import AsyncIOMainLoop
+from tornado.web import RequestHandler, Application, URLSpec, HTTPError, StaticFileHandler
+
+from geocoder import (address_index, admission, compression, es_client, metrics,
+                      municipality_index, offload, prefork, queries, reverse_index,
+                      road_index, suggest_index)
+from geocoder.admission import AdmissionControl, Overloaded
+from geocoder.cache import ResponseCache, SingleFlight
+from geocoder.es_client import Cancelled, ESClient, unless_cancelled
+from geocoder.offload import LagMonitor, Offloader
+from geocoder.suggest import (PrefixCandidates, SIZE, empty_response, section,
+                              suggestion_count)
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+EVENT_LOOPS = ('tornado', 'asyncio', 'uvloop')
 
 DATE = None
-ES_URL = "http://localhost:9200/reittiopas/"
+# Id of this worker process when running with --workers
+WORKER_ID = 0
+# Connection pool and URL for all queries to ES, set up in main
+ES = ESClient()
+SUGGEST_CACHE = ResponseCache()
+SUGGEST_CANDIDATES = PrefixCandidates()
+# Whether the suggest queries use the .ngram subfields instead of wildcards
+SUGGEST_NGRAM = True
+# Whether the suggest queries are sent in tiers, the second tier only when
+# the first finds fewer than SUGGEST_TIER_MIN streets and stops
+SUGGEST_TIERED = False
+SUGGEST_TIER_MIN = SIZE
+# If set, the suggest sub-queries are sent as separate requests, and the
+# response has whatever they found in this many seconds
+SUGGEST_DEADLINE = None
+# Kilometers around the focus point of a suggest request, if not given
+SUGGEST_RADIUS = 10
+# Identical ES queries in flight at the same time are only sent once
+ES_QUERIES = SingleFlight()
+# Concurrency limits and queues of the ES queries per endpoint
+ADMISSION = AdmissionControl()
+# Executor for decoding and transforming large ES responses
+OFFLOAD = Offloader()
+LAG_MONITOR = LagMonitor(metrics.LOOP_LAG)
+# In-memory indexes replacing ES queries, if loaded at startup
+ADDRESS_INDEX = None
+NEAREST_ADDRESS_INDEX = None
+MUNICIPALITY_INDEX = None
+ROAD_INDEX = None
+SUGGEST_INDEX = None
+# Maximum number of items in one batch request
+BATCH_LIMIT = 1000
+# Maximum number of points in one batch reverse geocoding request
+BATCH_REVERSE_LIMIT = 100000
+# Addresses per _msearch request sent to ES for a batch request
+BATCH_CHUNK = 100
+# Same characters as allowed in the address URLs (spaces are URL encoded
+# there). \Z, as $ would also match before a trailing newline.
+BATCH_NAME = re.compile(r"^[\w\-()\.' ]+\Z")
+# A number followed by the characters allowed in the address URLs. ASCII
+# only, as the number is rendered into the query as a JSON number.
+BATCH_NUMBER = re.compile(r"^\d+[\w\-]*\Z", re.ASCII)
+# Requests slower than this many seconds are logged with their query, if set
+SLOW_QUERY_TIME = None
+# Whether to also log the ES profile of the slow queries
+SLOW_QUERY_PROFILE = False
+SLOW_QUERY_LOG = logging.getLogger('geocoder.slow_queries')
+# Endpoints whose GET responses can be cached by clients and proxies
+CACHEABLE = ('address', 'street', 'suggest', 'interpolate', 'reverse', 'meta')
+# Cache-Control header values by endpoint
+CACHE_CONTROL = {}
+
+metrics.REGISTRY.register(metrics.Gauge(
+    'geocoder_es_in_flight', "ElasticSearch requests in flight.",
+    collect=lambda: {(): ES.in_flight}))
+metrics.REGISTRY.register(metrics.Gauge(
+    'geocoder_es_node_outstanding', "ElasticSearch requests in flight per node.",
+    ('node',), collect=lambda: {(node.url,): node.outstanding for node in ES.nodes}))
+metrics.REGISTRY.register(metrics.Gauge(
+    'geocoder_es_queries_in_flight',
+    "Distinct ElasticSearch queries in flight, after coalescing identical ones.",
+    collect=lambda: {(): len(ES_QUERIES)}))
+metrics.REGISTRY.register(metrics.Counter(
+    'geocoder_es_queued_total', "ElasticSearch requests that waited for a connection.",
+    collect=lambda: {(): ES.queued}))
+metrics.REGISTRY.register(metrics.Gauge(
+    'geocoder_admission_active', "Admitted ElasticSearch queries in flight.",
+    ('endpoint',), collect=lambda: {(name,): e.active
+                                    for name, e in ADMISSION.endpoints.items()}))
+metrics.REGISTRY.register(metrics.Gauge(
+    'geocoder_admission_waiting', "Requests waiting to be admitted.",
+    ('endpoint',), collect=lambda: {(name,): e.waiting
+                                    for name, e in ADMISSION.endpoints.items()}))
+metrics.REGISTRY.register(metrics.Counter(
+    'geocoder_admission_rejected_total',
+    "Requests rejected with 503 because of a full queue or a timeout.",
+    ('endpoint', 'reason'),
+    collect=lambda: dict([((name, 'queue_full'), e.queue_full)
+                          for name, e in ADMISSION.endpoints.items()] +
+                         [((name, 'timeout'), e.timeouts)
+                          for name, e in ADMISSION.endpoints.items()])))
+metrics.REGISTRY.register(metrics.Counter(
+    'geocoder_es_errors_total', "Failed ElasticSearch requests per node.",
+    ('node',), collect=lambda: {(node.url,): node.errors for node in ES.nodes}))
 
 
 def finish_request(handler):
-    '''Set CORS and content type headers and call finish on given handler.'''
+    '''
+    Set CORS, content type and cache headers and call finish on given handler.
+    '''
     if 'Origin' in handler.request.headers:
         handler.set_header('Access-Control-Allow-Origin', handler.request.headers['Origin'])
     else:
         handler.set_header('Access-Control-Allow-Origin', '*')
     handler.set_header('Content-Type', 'application/json')
+    if handler.request.method == 'GET':
+        cache_control = CACHE_CONTROL.get(handler.request.path.split('/')[1])
+        if cache_control:
+            handler.set_header('Cache-Control', cache_control)
     handler.finish()
 
 
+def data_etag(handler):
+    '''
+    Strong ETag of the data version and the response content. Tornado
+    sets it on successful GET responses, and answers requests with a
+    matching If-None-Match with 304 Not Modified.
+    '''
+    hasher = sha1()
+    for part in handler._write_buffer:  # pylint: disable=protected-access
+        hasher.update(part)
+    return '"%s-%s"' % (DATE or '', hasher.hexdigest())
+
+
 class MetaHandler(RequestHandler):
     '''RequestHandler for the meta endpoint.'''
     def get(self):
@@ -41,29 +170,302 @@ class MetaHandler(RequestHandler):
         self.write({'updated': DATE})
         finish_request(self)
 
+    def compute_etag(self):
+        return data_etag(self)
+
+
+class StatsHandler(RequestHandler):
+    '''RequestHandler for the internal statistics endpoint.'''
+    def get(self):
+        '''
+        Counters for sizing the in-process caches, for example::
+
+            {"worker": {"id": 0, "pid": 4021},
+             "suggest_cache": {"size": 1520, "max_size": 10000, "ttl": 300,
+                               "hits": 8090, "misses": 1520},
+             "suggest_prefix_cache": {"size": 920, "max_size": 10000, "ttl": 300,
+                                      "hits": 610, "misses": 4120},
+             "es_queries": {"in_flight": 3, "started": 9120, "coalesced": 430,
+                            "abandoned": 12},
+             "es_client": {"max_clients": 100, "in_flight": 3, "max_in_flight": 41,
+                           "requests": 9150, "queued": 0, "errors": 2,
+                           "connection_errors": 1, "hedged": 120, "hedge_wins": 80,
+                           "p95": 0.021,
+                           "nodes": [{"url": "http://es1:9200/reittiopas/",
+                                      "outstanding": 2, "requests": 4580,
+                                      "errors": 2, "ejected": false,
+                                      "ejections": 0},
+                                     ...]},
+             "admission": {"suggest": {"priority": 3, "limit": 40,
+                                       "queue_size": 100, "active": 12,
+                                       "waiting": 0, "admitted": 8120,
+                                       "queue_full": 0, "timeouts": 0,
+                                       "cancelled": 0},
+                           ...},
+             "offload": {"executor": "thread", "workers": 4, "min_size": 65536,
+                         "offloaded": 210, "inline": 9840, "max_loop_lag": 0.012}}
+
+        If max_in_flight reaches max_clients, or queued grows, requests
+        are waiting for a connection to ES and --es-max-clients can be raised.
+
+        "admission" has the limits, queue lengths and rejected requests
+        of every ES backed endpoint, see --admission.
+
+        "abandoned" queries were stopped because every client waiting for
+        them closed the connection, and "cancelled" requests left the
+        admission queue for the same reason.
+
+        "offload" tells how many ES responses were decoded and transformed
+        in the --executor, and "max_loop_lag" the longest time in seconds
+        the IOLoop was blocked.
+
+        With --workers, every worker process has its own caches and
+        counters, and the response comes from the worker that happened
+        to accept the request.
+        '''
+        self.write({'worker': {'id': WORKER_ID, 'pid': os.getpid()},
+                    'suggest_cache': SUGGEST_CACHE.stats(),
+                    'suggest_prefix_cache': SUGGEST_CANDIDATES.stats(),
+                    'es_queries': ES_QUERIES.stats(),
+                    'es_client': ES.stats(),
+                    'admission': ADMISSION.stats(),
+                    'offload': dict(OFFLOAD.stats(), max_loop_lag=LAG_MONITOR.max_lag)})
+        finish_request(self)
+
+
+class MetricsHandler(RequestHandler):
+    '''RequestHandler for metrics in the Prometheus text format.'''
+    def get(self):
+        '''
+        Request counts, latency histograms and in-flight ES requests
+        for monitoring and capacity planning. The time spent on an ES
+        backed request is split into the ES round trip, the query time
+        reported by ES, decoding the response and transforming it.
+
+        With --workers, every worker process has its own metrics.
+        Use --metrics-port to scrape each of them separately.
+
+        :responseheader Content-Type: text/plain; version=0.0.4; charset=utf-8
+
+        Example response::
+
+            # HELP geocoder_requests_total Finished requests by handler and HTTP status.
+            # TYPE geocoder_requests_total counter
+            geocoder_requests_total{handler="SuggestHandler",status="200"} 8120.0
+            ...
+        '''
+        self.set_header('Content-Type', metrics.CONTENT_TYPE)
+        self.write(metrics.REGISTRY.render())
+
+
+def log_request(handler):
+    '''Count a finished request in the metrics and write the access log.'''
+    name = type(handler).__name__
+    status = handler.get_status()
+    request_time = handler.request.request_time()
+    metrics.REQUESTS.inc(name, str(status))
+    metrics.REQUEST_TIME.observe(request_time, name)
+    if status < 400:
+        log_method = access_log.info
+    elif status < 500:
+        log_method = access_log.warning
+    else:
+        log_method = access_log.error
+    log_method("%d %s %.2fms", status,
+               handler._request_summary(),  # pylint: disable=protected-access
+               1000.0 * request_time)
+
+
+def retry_after(handler, exc_info):
+    '''Tell clients rejected by admission control when to try again.'''
+    if exc_info is not None and isinstance(exc_info[1], Overloaded):
+        handler.set_header('Retry-After', str(exc_info[1].retry_after))
+
+
+def server_timing(timings):
+    '''Server-Timing header value of (name, seconds) pairs.'''
+    return ', '.join('%s;dur=%.2f' % (name, seconds * 1000) for name, seconds in timings)
+
+
+async def log_profile(url, body):
+    '''
+    Send a query again with ES profiling enabled and log the profile.
+    ES before 2.2 doesn't know the profile option and answers with 400,
+    which is logged instead.
+    '''
+    multi = url.startswith('_msearch')
+    response = await ES.fetch(url, queries.with_profile(body, multi), raise_error=False)
+    if response.error:
+        SLOW_QUERY_LOG.warning("Could not profile query: %s", response.error)
+        return
+    data = json.loads(response.body.decode('utf-8'))
+    if multi:
+        profile = [r.get('profile') for r in data['responses']]
+    else:
+        profile = data.get('profile')
+    SLOW_QUERY_LOG.warning("Profile of %s: %s", url, json.dumps(profile))
+
+
+def decode_response(body):
+    '''The decoded JSON of an ES response body, and the seconds it took.'''
+    start = monotonic()
+    data = json.loads(body.decode('utf-8'))
+    return data, monotonic() - start
+
+
+async def settle(future):
+    '''Wait for a future, ignoring its failure, which its caller handles.'''
+    try:
+        await future
+    except Exception:  # pylint: disable=broad-except
+        pass
+
 
 class Handler(RequestHandler):
     '''Superclass for other endpoints.'''
-    @asynchronous
-    def get(self, template_string, url, **kwargs):
-        body = Template(template_string).render(kwargs)
-        logging.debug("Sending query: %s", body)
-        AsyncHTTPClient().fetch(ES_URL + url,
-                                allow_nonstandard_methods=True,
-                                body=body,
-                                callback=self.on_response)
+    # Whether a slow query may be duplicated to another ES node
+    hedge = False
+    # Names of the _msearch subqueries, for the timing of each
+    subqueries = ()
+    # Admission control endpoint of the ES queries
+    endpoint = None
+    # Resolved when every request waiting for the shared query is gone
+    abandoned = None
+    # Bytes of the ES responses to the shared query so far
+    response_size = 0
+
+    def prepare(self):
+        # Resolved when the client closes the connection
+        self.closed = Future()
+
+    def on_connection_close(self):
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    def write_error(self, status_code, **kwargs):
+        retry_after(self, kwargs.get('exc_info'))
+        super().write_error(status_code, **kwargs)
+
+    def compute_etag(self):
+        return data_etag(self)
+
+    async def get(self, url, body):
+        '''
+        Respond with the transformed ES response to the query. If an
+        identical query from the same endpoint is already in flight,
+        wait for its result instead of sending another one.
+
+        If the client closes the connection, the request stops waiting,
+        and once no request waits for the query, nothing more is sent
+        to ES for it.
 
-    def on_response(self, response):
+        The response has a Server-Timing header with the time taken to
+        render the query, wait for ES, process each subquery in ES
+        (reported by ES as "took"), decode, transform and serialize.
+        '''
+        timings = [('render', self.request.request_time())]
+        start = monotonic()
+        result, details = await unless_cancelled(
+            ES_QUERIES.run(self.query_key(url, body),
+                           lambda abandoned: self.start_query(url, body, abandoned),
+                           self.closed),
+            self.closed)
+        # The shared query's own timings, apart from the time spent waiting for ES
+        processing = sum(seconds for name, seconds in details
+                         if name in ('decode', 'transform'))
+        timings.append(('es', monotonic() - start - processing))
+        timings.extend(details)
+        start = monotonic()
+        self.write(result)
+        timings.append(('serialize', monotonic() - start))
+        self.set_header('Server-Timing', server_timing(timings))
+        finish_request(self)
+        self.log_if_slow(url, body, timings)
+
+    def query_key(self, url, body):
+        '''
+        Key of requests that can share a response. The result of
+        transform must depend only on what's in the key.
+        '''
+        return (type(self).__name__, url, body)
+
+    def start_query(self, url, body, abandoned):
+        '''Start the shared query, which stops when abandoned resolves.'''
+        self.abandoned = abandoned
+        return gen.convert_yielded(self.query_es(url, body))
+
+    def log_if_slow(self, url, body, timings):
+        '''Log the query and its timings if the request was slow.'''
+        elapsed = self.request.request_time()
+        if not SLOW_QUERY_TIME or elapsed < SLOW_QUERY_TIME:
+            return
+        SLOW_QUERY_LOG.warning("%s took %.2fms (%s), query to %s:\n%s",
+                               self.request.uri, elapsed * 1000,
+                               server_timing(timings), url, body)
+        if SLOW_QUERY_PROFILE:
+            IOLoop.current().spawn_callback(log_profile, url, body)
+
+    async def query_es(self, url, body):
+        '''
+        Send the query to ElasticSearch and transform its response.
+        Returns the result and the (name, seconds) timings of the steps.
+        '''
+        data, details = await self.fetch_es(url, body, self.subqueries)
+        name = type(self).__name__
+        start = monotonic()
+        try:
+            result = await self.transform(data)
+        finally:
+            transform = monotonic() - start
+            metrics.TRANSFORM_TIME.observe(transform, name)
+        return result, details + [('transform', transform)]
+
+    async def fetch_es(self, url, body, subqueries=()):
+        '''
+        Send the query to ElasticSearch and decode its response. Returns
+        the data and the timings of ES and decoding. subqueries are the
+        names of the _msearch sub-queries in the body.
+        '''
+        logging.debug("Sending query: %s", body)
+        name = type(self).__name__
+        start = monotonic()
+        await ADMISSION.acquire(self.endpoint, self.abandoned)
+        metrics.ADMISSION_WAIT.observe(monotonic() - start, self.endpoint)
+        start = monotonic()
+        try:
+            response = await ES.fetch(url, body, hedge=self.hedge, raise_error=False,
+                                      cancelled=self.abandoned)
+        finally:
+            ADMISSION.release(self.endpoint)
+        metrics.ES_TIME.observe(monotonic() - start, name)
         logging.debug("Got response: %s", response)
-        '''Callback for handling replies from ElasticSearch.'''
         if response.error:
             logging.error(response)
             if response.body:
                 logging.error(response.body.decode())
             logging.error(response.request.body.decode())
             raise HTTPError(500)
-        self.write(self.transform_es(json.loads(response.body.decode('utf-8'))))
-        finish_request(self)
+        self.response_size += len(response.body)
+        data, decode = await OFFLOAD.run(len(response.body), decode_response,
+                                         response.body)
+        metrics.DECODE_TIME.observe(decode, name)
+        if 'responses' in data:
+            # _msearch responses report the time of each search separately
+            took = []
+            for i, r in enumerate(data['responses']):
+                subquery = subqueries[i] if i < len(subqueries) else str(i)
+                took.append(('took_' + subquery, r.get('took', 0) / 1000))
+        else:
+            took = [('took', data.get('took', 0) / 1000)]
+        metrics.ES_TOOK.observe(max(seconds for _, seconds in took), name)
+        return data, took + [('decode', decode)]
+
+    async def transform(self, data):
+        '''
+        Transform the decoded ES response. Handlers with heavy work on
+        large responses run it with OFFLOAD here.
+        '''
+        return self.transform_es(data)
 
     def transform_es(self, data):
         """
@@ -72,10 +474,84 @@ class Handler(RequestHandler):
         return data
 
 
+def merge_addresses(hri_addresses, osm_addresses):
+    '''
+    Merge HRI and OSM address documents into the address endpoint format,
+    preferring OSM when both have the same address. Sorted by house number.
+    '''
+    addresses = {}
+    for addr in osm_addresses:
+        addresses[(addr['municipality'], addr['street'], addr['number'])] = {
+            # XXX Issue #26, multilingual OSM data
+            'municipalityFi': addr['municipality'],
+            'municipalitySv': addr['municipality'],
+            'streetFi': addr['street'],
+            'streetSv': addr['street'],
+            'number': addr['number'],
+            'unit': addr['unit'],
+            'location': addr['location'],
+            'source': 'OSM'
+        }
+    for addr in hri_addresses:
+        if addr['osoitenumero'] == addr['osoitenumero2']:
+            number = str(addr['osoitenumero']) + addr['kiinteiston_jakokirjain']
+        else:
+            number = str(addr['osoitenumero']) + '-' + str(addr['osoitenumero2'])
+        id = (addr['kaupunki'], addr['katunimi'], number)
+        if id not in addresses:
+            addresses[id] = {
+                'municipalityFi': addr['kaupunki'],
+                'municipalitySv': addr['staden'],
+                'streetFi': addr['katunimi'],
+                'streetSv': addr['gatan'],
+                'number': number,
+                'unit': None,
+                'location': addr['location'],
+                'source': 'HRI.fi'
+            }
+        else:
+            logging.info('Returning OSM address instead of official: %s', id)
+
+    def address_key(a):
+        number, divisor = re.match(r'(\d+)(\D*)', a['number']).groups()
+        return (int(number), divisor)
+
+    return sorted(list(addresses.values()), key=address_key)
+
+
+def address_parameters(city, streetname, streetnumber):
+    '''
+    Parameters of the address query for an address.
+
+    Raises ValueError if the street number doesn't start with a number.
+    '''
+    match = re.match(r'(\d+)(\D*)', streetnumber)
+    if match is None:
+        raise ValueError("Invalid street number: %s" % streetnumber)
+    number, divisor = match.groups()
+    return {'city': city,
+            'streetname': streetname,
+            'streetnumber': streetnumber,
+            'number': number,
+            'divisor': divisor,
+            # In Finland, when looking from the beginning of a street to end,
+            # right side always has odd and left side even numbers
+            'left_side': 'true' if int(number) % 2 == 0 else 'false'}
+
+
+def find_address_in_index(parameters):
+    '''HRI and OSM address documents from the in-memory index.'''
+    return ADDRESS_INDEX.address(parameters['city'], parameters['streetname'],
+                                 parameters['streetnumber'], parameters['number'],
+                                 parameters['divisor'])
+
+
 class AddressSearchHandler(Handler):
     '''RequestHandler for the getting the location of one address.'''
+    subqueries = queries.ADDRESS_NAMES
+    endpoint = 'address'
 
-    def get(self, **kwargs):
+    async def get(self, **kwargs):
         '''
         Get an address location as hijack protected JSON array
         in an object under the name "results".
@@ -83,105 +559,36 @@ class AddressSearchHandler(Handler):
         The response format is identical to the street search endpoint,
         except that the array contains only one element.
         '''
-        number, divisor = re.match(r'(\d+)(\D*)', kwargs['streetnumber']).groups()
-        kwargs['number'] = number
-        kwargs['divisor'] = divisor
-
-        # In Finland, when looking from the beginning of a street to end,
-        # right side always has odd and left side even numbers
-        if int(number) % 2 == 0:
-            kwargs['left_side'] = 'true'
-        else:
-            kwargs['left_side'] = 'false'
-        super().get(
-            # noqa
-            url="_msearch",
-            template_string='{"type": "address"}\n'
-                            '{"query": {'
-                               '"filtered": {'
-                                 '"filter": {'
-                                   '"bool" : {'
-                                     '"must" : ['
-                                       '{or: ['
-                                         '{"term": {"kaupunki.lower": "{{ city.lower() }}"}},'
-                                         '{"term": {"staden.lower": "{{ city.lower() }}"}}'
-                                       ']},'
-                                       '{or: ['
-                                         '{"term": {"katunimi.lower": "{{ streetname.lower() }}"}},'
-                                         '{"term": {"gatan.lower": "{{ streetname.lower() }}"}}'
-                                       ']},'
-                                       '{% if divisor %}'
-                                       '{"term": {"osoitenumero": "{{ number }}"}},'
-                                       '{"term": {"kiinteiston_jakokirjain": "{{ divisor }}"}}'
-                                       '{% else %}'
-                                       '{"range": {'
-                                         '"osoitenumero": {"lte": {{ streetnumber }} }}},'
-                                       '{"range": {'
-                                         '"osoitenumero2": {"gte" : {{ streetnumber }} }}},'
-                                         '{"term": {"left_side": "{{ left_side }}" }}'
-                                       '{% endif %}'
-                            ']}}}}}\n'
-                            '{"type": "osm_address"}\n'
-                            '{"query": {'
-                               '"filtered": {'
-                                 '"filter": {'
-                                   '"bool" : {'
-                                     '"must" : ['
-                                       '{"term": { "municipality": "{{ city.lower() }}"}},'
-                                       '{"term": { "street": "{{ streetname.title() }}"}},'  # XXX Title case doesn't work for "Ida Aalbergin tie"
-                                       '{"term": { "number": "{{ streetnumber }}" }}'
-                            ']}}}}}\n'
-                            '\n',
-            **kwargs)
+        try:
+            parameters = address_parameters(**kwargs)
+        except ValueError:
+            raise HTTPError(400)
+        if ADDRESS_INDEX is not None:
+            self.respond_from_index(*find_address_in_index(parameters))
+            return
+        await super().get("_msearch", queries.msearch([queries.ADDRESS.render(parameters)]))
+
+    def respond_from_index(self, hri_addresses, osm_addresses):
+        '''Respond with addresses found in the in-memory index.'''
+        results = merge_addresses(hri_addresses, osm_addresses)
+        if not results:
+            raise HTTPError(404)
+        self.write({'results': results})
+        finish_request(self)
 
     def transform_es(self, data):
-        addresses = {}
-        for addr in [x['_source'] for x in data['responses'][1]["hits"]["hits"]]:
-            addresses[(addr['municipality'], addr['street'], addr['number'])] = {
-                # XXX Issue #26, multilingual OSM data
-                'municipalityFi': addr['municipality'],
-                'municipalitySv': addr['municipality'],
-                'streetFi': addr['street'],
-                'streetSv': addr['street'],
-                'number': addr['number'],
-                'unit': addr['unit'],
-                'location': addr['location'],
-                'source': 'OSM'
-            }
-        for addr in [x['_source'] for x in data['responses'][0]["hits"]["hits"]]:
-            if addr['osoitenumero'] == addr['osoitenumero2']:
-                number = str(addr['osoitenumero']) + addr['kiinteiston_jakokirjain']
-            else:
-                number = str(addr['osoitenumero']) + '-' + str(addr['osoitenumero2'])
-            id = (addr['kaupunki'], addr['katunimi'], number)
-            if id not in addresses:
-                addresses[id] = {
-                    'municipalityFi': addr['kaupunki'],
-                    'municipalitySv': addr['staden'],
-                    'streetFi': addr['katunimi'],
-                    'streetSv': addr['gatan'],
-                    'number': number,
-                    'unit': None,
-                    'location': addr['location'],
-                    'source': 'HRI.fi'
-                }
-            else:
-                logging.info('Returning OSM address instead of official: %s', id)
-
-        if not addresses:
+        results = merge_addresses(
+            [x['_source'] for x in data['responses'][0]["hits"]["hits"]],
+            [x['_source'] for x in data['responses'][1]["hits"]["hits"]])
+        if not results:
             raise HTTPError(404)
-
-        def address_key(a):
-            number, divisor = re.match(r'(\d+)(\D*)', a['number']).groups()
-            return (int(number), divisor)
-
-        return {'results': sorted(list(addresses.values()), key=address_key)}
+        return {'results': results}
 
 
 class StreetSearchHandler(AddressSearchHandler):
     '''RequestHandler for getting all the house numbers on a street.'''
 
-    def get(self, **kwargs):
+    async def get(self, **kwargs):
         '''
         Get all address locations on a street as a hijack protected JSON array
         in an object under the name "results".
@@ -224,45 +631,173 @@ class StreetSearchHandler(AddressSearchHandler):
                 ...
             ]}
         '''
-        super(AddressSearchHandler, self).get(
-            # noqa
-            url="_msearch",
-            template_string='{"type": "address"}\n'
-                            '{"size": 10,'
-                             '"query": {'
-                               '"filtered": {'
-                                 '"filter": {'
-                                   '"bool" : {'
-                                     '"must" : ['
-                                       '{or: ['
-                                         '{"term": {"kaupunki.lower": "{{ city.lower() }}"}},'
-                                         '{"term": {"staden.lower": "{{ city.lower() }}"}}'
-                                       ']},'
-                                       '{or: ['
-                                         '{"term": {"katunimi.lower": "{{ streetname.lower() }}"}},'
-                                         '{"term": {"gatan.lower": "{{ streetname.lower() }}"}}'
-                                       ']}'
-                            ']}}}}}\n'
-                            '{"type": "osm_address"}\n'
-                            '{"size": 10,'
-                             '"query": {'
-                               '"filtered": {'
-                                 '"filter": {'
-                                   '"bool" : {'
-                                     '"must" : ['
-                                       '{"term": { "municipality": "{{ city.lower() }}"}},'
-                                       '{"term": { "street": "{{ streetname.title() }}"}}'  # XXX Title case doesn't work for "Ida Aalbergin tie"
-                            ']}}}}}\n'
-                            '\n',
-            **kwargs)
+        if ADDRESS_INDEX is not None:
+            self.respond_from_index(*ADDRESS_INDEX.street(**kwargs))
+            return
+        await super(AddressSearchHandler, self).get(
+            "_msearch", queries.msearch([queries.STREET.render(kwargs)]))
+
+
+class BatchAddressHandler(RequestHandler):
+    '''RequestHandler for geocoding many addresses in one request.'''
+
+    def prepare(self):
+        self.closed = Future()
+
+    def on_connection_close(self):
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    def write_error(self, status_code, **kwargs):
+        retry_after(self, kwargs.get('exc_info'))
+        super().write_error(status_code, **kwargs)
+
+    async def post(self):
+        '''
+        Get the locations of up to 1000 addresses (configurable) at once.
+        The addresses are given as a JSON object::
+
+            {"addresses": [
+                {"city": "Helsinki", "streetname": "Mannerheimintie", "streetnumber": "13"},
+                {"city": "Vantaa", "streetname": "Virsutie", "streetnumber": "5"}
+            ]}
+
+        The results are in the same order as the addresses in the request.
+        Each result has the HTTP status the address endpoint would have given
+        for that address, and the found addresses in the address endpoint
+        format under the name "results".
+
+        :status 400: if the body is not a JSON object with a list of at most the maximum number of addresses
+
+        Example response::
+
+            {"results": [
+                {"status": 200,
+                 "results": [{"municipalityFi" : "Helsinki",
+                              "streetFi" : "Mannerheimintie",
+                              ...}]},
+                {"status": 404}
+            ]}
+        '''
+        try:
+            items = json.loads(self.request.body.decode('utf-8'))['addresses']
+        except (ValueError, KeyError, TypeError):
+            raise HTTPError(400)
+        if not isinstance(items, list) or len(items) > BATCH_LIMIT:
+            raise HTTPError(400)
+
+        results = [None] * len(items)
+        found = []
+        for i, item in enumerate(items):
+            try:
+                if not all(BATCH_NAME.match(item[field])
+                           for field in ('city', 'streetname')):
+                    raise ValueError("Invalid name")
+                # Rendered into the shared _msearch body, so anything
+                # else could break or change the queries of other items
+                streetnumber = str(item['streetnumber'])
+                if not BATCH_NUMBER.match(streetnumber):
+                    raise ValueError("Invalid street number")
+                found.append((i, address_parameters(
+                    item['city'], item['streetname'], streetnumber)))
+            except (KeyError, TypeError, ValueError):
+                results[i] = {'status': 400}
+
+        if ADDRESS_INDEX is not None:
+            for i, parameters in found:
+                results[i] = batch_result(
+                    merge_addresses(*find_address_in_index(parameters)))
+        else:
+            chunks = [found[start:start + BATCH_CHUNK]
+                      for start in range(0, len(found), BATCH_CHUNK)]
+            await ADMISSION.acquire('batch', self.closed)
+            try:
+                responses = await gen.multi([
+                    ES.fetch("_msearch", queries.msearch([queries.ADDRESS.render(p)
+                                                          for _, p in chunk]),
+                             cancelled=self.closed)
+                    for chunk in chunks], quiet_exceptions=Cancelled)
+            except HTTPClientError as e:
+                logging.error(e)
+                raise HTTPError(500)
+            finally:
+                ADMISSION.release('batch')
+            for chunk, response in zip(chunks, responses):
+                data = (await OFFLOAD.run(len(response.body), decode_response,
+                                          response.body))[0]['responses']
+                for n, (i, _) in enumerate(chunk):
+                    hri, osm = data[2 * n], data[2 * n + 1]
+                    if 'error' in hri or 'error' in osm:
+                        logging.error("Batch address query failed: %s",
+                                      hri.get('error') or osm.get('error'))
+                        results[i] = {'status': 500}
+                        continue
+                    results[i] = batch_result(merge_addresses(
+                        [x['_source'] for x in hri["hits"]["hits"]],
+                        [x['_source'] for x in osm["hits"]["hits"]]))
+        self.write({'results': results})
+        finish_request(self)
+
+
+def batch_result(results):
+    '''A batch result item with the status of the corresponding single request.'''
+    if not results:
+        return {'status': 404}
+    return {'status': 200, 'results': results}
+
+
+def suggest_subqueries(sources):
+    '''
+    Names of the suggest subqueries chosen with the sources arguments,
+    which are comma separated names of queries.SUGGEST_SOURCES or single
+    subqueries. All of them if there are none.
+    '''
+    selected = set()
+    for source in ','.join(sources).split(','):
+        if source in queries.SUGGEST_SOURCES:
+            selected.update(queries.SUGGEST_SOURCES[source])
+        elif source in queries.SUGGEST_NAMES:
+            selected.add(source)
+        elif source:
+            raise HTTPError(400)
+    return selected or set(queries.SUGGEST_NAMES)
+
+
+def suggest_geo(bbox, focus, radius):
+    '''
+    Rendered location filter of the suggest subqueries from the bbox, or
+    the focus and radius arguments, or None if neither was given.
+    '''
+    try:
+        if bbox is not None:
+            bbox = [float(x) for x in bbox.split(',')]
+            if (len(bbox) != 4 or not all(isfinite(x) for x in bbox) or
+                    bbox[0] >= bbox[2] or bbox[1] >= bbox[3]):
+                raise ValueError("Invalid bbox")
+            return queries.SUGGEST_GEO.render(bbox=bbox)
+        if focus is not None:
+            lat, lon = [float(x) for x in focus.split(',')]
+            radius = float(radius) if radius else SUGGEST_RADIUS
+            if not all(isfinite(x) for x in (lat, lon, radius)) or radius <= 0:
+                raise ValueError("Invalid focus")
+            return queries.SUGGEST_GEO.render(lat=lat, lon=lon, radius=radius)
+    except ValueError:
+        raise HTTPError(400)
+    return None
 
 
 class SuggestHandler(Handler):
     """RequestHandler for autocomplete/typo fix suggestions."""
+    hedge = True
+    endpoint = 'suggest'
 
-    def get(self, **kwargs):
+    async def get(self, **kwargs):
         '''
         :query string city: Limit the results to within given city. Can be given multiple times to limit within all the cities.
+        :query string sources: Comma separated list of the results to search for, any of streets, stops and fuzzy, or single queries like stops_name_fi. All of them by default, the others are returned empty.
+        :query string bbox: Limit the results to within min lon,min lat,max lon,max lat
+        :query string focus: Limit the results to within radius of lat,lon
+        :query float radius: Radius in km around the focus point, 10 by default
 
         The stop objects contain all data available from Digiroad,
         but currently only following fields are specified,
@@ -330,6 +865,12 @@ class SuggestHandler(Handler):
                  ...
             ]}
 
+        With ``--suggest-deadline``, the sections whose queries didn't
+        answer in time are empty and listed as incomplete::
+
+            "fuzzy_streetnames" : [],
+            "incomplete" : ["fuzzy_streetnames"]
+
         If a streetname is found in multiple cities,
         the response includes all of them::
 
@@ -342,212 +883,217 @@ class SuggestHandler(Handler):
                      "doc_count" : 6
             }]}],
         '''
-        kwargs['cities'] = self.get_arguments('city')
-        super().get(
-            # noqa
+        self.search_term = kwargs['search_term']
+        cities = self.get_arguments('city')
+        self.selected = suggest_subqueries(self.get_arguments('sources'))
+        self.geo = suggest_geo(self.get_argument('bbox', None),
+                               self.get_argument('focus', None),
+                               self.get_argument('radius', None))
+        # All queries are case insensitive, so the cache keys are too
+        self.cities_key = tuple(sorted(city.lower() for city in cities))
+        self.cache_key = (self.search_term.lower(), self.cities_key,
+                          tuple(sorted(self.selected)), self.geo)
+        # Sub-queries that didn't answer before the deadline
+        self.incomplete = set()
+        SUGGEST_CACHE.set_version(DATE)
+        SUGGEST_CANDIDATES.set_version(DATE)
+        cached = SUGGEST_CACHE.get(self.cache_key)
+        if cached is not None:
+            self.write(cached)
+            finish_request(self)
+            return
+
+        # The in-memory index doesn't know the locations of the streets
+        if SUGGEST_INDEX is not None and self.geo is None:
+            responses = SUGGEST_INDEX.suggest(self.search_term, self.cities_key)
+            self.write(self.suggestions([
+                response if name in self.selected else empty_response(name)
+                for name, response in zip(queries.SUGGEST_NAMES, responses)]))
+            finish_request(self)
+            return
+
+        self.cities = cities
+        # Sub-responses by sub-query name
+        self.responses = {}
+        # Sub-queries to send if the first tier finds too few suggestions
+        self.next_tier = ()
+        # Only the results of all sub-queries without a location filter
+        # are kept for narrowing
+        self.candidates = None
+        if self.geo is None and len(self.selected) == len(queries.SUGGEST_NAMES):
+            self.candidates = SUGGEST_CANDIDATES.find(self.search_term, self.cities_key)
+        if self.candidates is not None:
+            self.responses.update(zip(queries.SUGGEST_NAMES, self.candidates))
+            if SUGGEST_TIERED and suggestion_count(self.responses) >= SUGGEST_TIER_MIN:
+                self.write(self.suggestions(self.candidates + [empty_response('fuzzy')]))
+                finish_request(self)
+                return
+            # The streets and stops were narrowed from a shorter search term,
+            # but typo fixes don't shrink along with the term.
+            self.subqueries = ('fuzzy',)
+            await super().get("_msearch", queries.msearch(
+                [queries.SUGGEST_FUZZY.render(search_term=self.search_term)]))
+        else:
             # _msearch allows multiple queries at the same time,
             # but is very finicky about the format.
-            url="_msearch",
-             # All queries are case insensitive
-            template_string=''
-             # Find street names by matching correctly written part from middle
-             '{"search_type" : "count", "type": "address"}\n'
-             '{"query": {'
-                '"filtered": {'
-                 '"query": {'
-                   '"wildcard": {'
-                     '"katunimi.lower": "*{{ search_term.lower() }}*"}'
-                  '}'
-                  '{% if cities %}'
-                  ',"filter": {'
-                    'or: ['
-                    '{% for city in cities %}'
-                      '{"term": {"kaupunki.lower": "{{ city.lower() }}"}},'
-                      '{"term": {"staden.lower": "{{ city.lower() }}"}}'
-                      '{% if not loop.last %},{% endif %}'
-                    '{% endfor %}'
-                    ']}'
-                '{% endif %}'
-              '}},'
-              '"aggs": {'
-                '"streets": {'
-                  '"terms": { "field": "katunimi", "size": 10 },'
-                  '"aggs": {'
-                    '"cities": {'
-                      '"terms": { "field": "kaupunki", "size": 10 }}}}}}\n'
-             '{"search_type" : "count", "type": "address"}\n'
-             '{"query": {'
-                '"filtered": {'
-                 '"query": {'
-                   '"wildcard": {'
-                     '"gatan.lower": "*{{ search_term.lower() }}*"}'
-                  '}'
-                  '{% if cities %}'
-                  ',"filter": {'
-                    'or: ['
-                    '{% for city in cities %}'
-                      '{"term": {"kaupunki.lower": "{{ city.lower() }}"}},'
-                      '{"term": {"staden.lower": "{{ city.lower() }}"}}'
-                      '{% if not loop.last %},{% endif %}'
-                    '{% endfor %}'
-                    ']}'
-                '{% endif %}'
-              '}},'
-              '"aggs": {'
-                '"streets": {'
-                  '"terms": { "field": "gatan", "size": 10 },'
-                  '"aggs": {'
-                    '"cities": {'
-                      '"terms": { "field": "staden", "size": 10 }}}}}}\n'
-             # Find correctly written stops from names
-             '{"type": "digiroad_stop"}\n'
-             '{"size": 10, "query": {'
-                '"filtered": {'
-                 '"query": {'
-                   '"wildcard": {'
-                      '"NAME_FI": "*{{ search_term.lower() }}*"}'
-                  '}'
-                  '{% if cities %}'
-                  ',"filter": {'
-                    'or: ['
-                    '{% for city in cities %}'
-                      '{"term": {"MUNICIPALITY_NAME": "{{ city.lower() }}"}}'
-                      '{% if not loop.last %},{% endif %}'
-                    '{% endfor %}'
-                    ']}'
-                '{% endif %}'
-                '}}}\n'
-             '{"type": "digiroad_stop"}\n'
-             '{"size": 10, "query": {'
-                '"filtered": {'
-                 '"query": {'
-                   '"wildcard": {'
-                      '"NAME_SV": "*{{ search_term.lower() }}*"}'
-                  '}'
-                  '{% if cities %}'
-                  ',"filter": {'
-                    'or: ['
-                    '{% for city in cities %}'
-                      '{"term": {"MUNICIPALITY_NAME": "{{ city.lower() }}"}}'
-                      '{% if not loop.last %},{% endif %}'
-                    '{% endfor %}'
-                    ']}'
-                '{% endif %}'
-                '}}}\n'
-             # Find correctly written stops from descriptions
-             # (often crossing street name, or closest address)
-             '{"type": "digiroad_stop"}\n'
-             '{"size": 10, "query": {'
-                '"filtered": {'
-                 '"query": {'
-                   '"wildcard": {'
-                      '"COMMENTS": "*{{ search_term.lower() }}*"}'
-                  '}'
-                  '{% if cities %}'
-                  ',"filter": {'
-                    'or: ['
-                    '{% for city in cities %}'
-                      '{"term": {"MUNICIPALITY_NAME": "{{ city.lower() }}"}}'
-                      '{% if not loop.last %},{% endif %}'
-                    '{% endfor %}'
-                    ']}'
-                '{% endif %}'
-                '}}}\n'
-             # Find correctly written stop codes
-             '{"type": "digiroad_stop"}\n'
-             '{"size": 10, "query": {'
-                '"filtered": {'
-                 '"query": {'
-                   '"wildcard": {'
-                      '"STOP_CODE": "*{{ search_term.lower() }}*"}'
-                  '}'
-                  '{% if cities %}'
-                  ',"filter": {'
-                    'or: ['
-                    '{% for city in cities %}'
-                      '{"term": {"MUNICIPALITY_NAME": "{{ city.lower() }}"}}'
-                      '{% if not loop.last %},{% endif %}'
-                    '{% endfor %}'
-                    ']}'
-                '{% endif %}'
-                '}}}\n'
-             # Find stops by address
-             '{"type": "digiroad_stop"}\n'
-             '{"size": 10, "query": {'
-                '"filtered": {'
-                 '"query": {'
-                   '"wildcard": {'
-                      '"ADDRESS": "*{{ search_term.lower() }}*"}'
-                  '}'
-                  '{% if cities %}'
-                  ',"filter": {'
-                    'or: ['
-                    '{% for city in cities %}'
-                      '{"term": {"MUNICIPALITY_NAME": "{{ city.lower() }}"}}'
-                      '{% if not loop.last %},{% endif %}'
-                    '{% endfor %}'
-                    ']}'
-                '{% endif %}'
-                '}}}\n'
-             # Find incorrectly written street names with maximum Levenstein
-             # distance of 2 (hardcoded into Elasticsearch)
-             # XXX Would be nice if we could do a fuzzy wildcard search...
-             # http://www.elastic.co/guide/en/elasticsearch/reference/master/search-suggesters-completion.html
-             # allows at least fuzzy prefix suggestions
-             '{"search_type" : "count", "type": "address"}\n'
-             '{"query": {'
-                '"fuzzy": {'
-                  '"katunimi.lower": "{{ search_term.lower() }}"}},'
-              '"aggs": {'
-                '"streets": {"terms": {"field": "katunimi", "size": 10 }}}}\n'
-             '\n',  # ES requires a blank line at the end (not documented)
-             **kwargs)
-
-    def transform_es(self, data):
-        r = data['responses']
-        streetnames_fi = []
-        for s in r[0]["aggregations"]["streets"]["buckets"]:
-            streetnames_fi.append({s["key"]: s["cities"]["buckets"]})
-        streetnames_sv = []
-        for s in r[1]["aggregations"]["streets"]["buckets"]:
-            streetnames_sv.append({s["key"]: s["cities"]["buckets"]})
-        stops = {}
-        for s in (r[2]["hits"]["hits"] + r[3]["hits"]["hits"] +
-                  r[4]["hits"]["hits"] + r[5]["hits"]["hits"] + r[6]["hits"]["hits"]):
-            if s["_id"] not in stops:  # A stop might match in multiple searches
-                new_stop = s["_source"]
-                # Rename some fields
-                for rename in [('NAME_FI', 'nameFi'),
-                               ('NAME_SV', 'nameSv'),
-                               ('STOP_CODE', 'stopCode'),
-                               ('ADDRESS', 'address'),
-                               ('MUNICIPALITY_NAME', 'municipalityFi'),
-                               ('COMMENTS', 'stopDesc')]:
-                    new_stop[rename[1]] = new_stop[rename[0]]
-                    del new_stop[rename[0]]
-
-                stops[s["_id"]] = new_stop
-        return {
-            # Address is a single key/value dict, where the streetname is the key.
-            # In Python3 it's a bit tricky to get that key:
-            # dict_keys -> iterator -> value
-            'streetnames_fi': sorted(streetnames_fi,
-                                     key=lambda x: x.keys().__iter__().__next__()),
-            'streetnames_sv': sorted(streetnames_sv,
-                                     key=lambda x: x.keys().__iter__().__next__()),
-            'stops': sorted(list(stops.values()),
-                            key=lambda x: x['nameFi'] + x['stopDesc']),
-            'fuzzy_streetnames': r[7]["aggregations"]["streets"]["buckets"],
-        }
+            if SUGGEST_TIERED:
+                self.subqueries = self.select(queries.SUGGEST_TIERS[0])
+                self.next_tier = self.select(queries.SUGGEST_TIERS[1])
+                if not self.subqueries:
+                    self.subqueries, self.next_tier = self.next_tier, ()
+            else:
+                self.subqueries = self.select(queries.SUGGEST_NAMES)
+            await super().get("_msearch", self.msearch_body(self.subqueries))
+
+    def select(self, subqueries):
+        '''The subqueries chosen with the sources argument.'''
+        return tuple(name for name in subqueries if name in self.selected)
+
+    def msearch_body(self, subqueries):
+        '''The _msearch body of the subqueries.'''
+        return queries.suggest(self.search_term, self.cities, SUGGEST_NGRAM,
+                               subqueries, self.geo)
+
+    def query_key(self, url, body):
+        # The result also depends on the chosen sources, the narrowed prefix
+        # candidates added to it and the tier that may follow, not just on
+        # the query sent first
+        return super().query_key(url, body) + (self.cache_key,
+                                               self.candidates is not None,
+                                               self.next_tier)
+
+    async def query_es(self, url, body):
+        result, details = await self.query_subqueries(url, body)
+        if result is None:
+            # The first tier found too few suggestions
+            self.subqueries, self.next_tier = self.next_tier, ()
+            result, more = await self.query_subqueries(
+                url, self.msearch_body(self.subqueries))
+            details = details + more
+        return result, details
+
+    async def query_subqueries(self, url, body):
+        '''
+        Send the sub-queries in one _msearch, or with SUGGEST_DEADLINE,
+        each in an _msearch of its own at the same time. Sub-queries that
+        fail or don't answer by the deadline are left out of the result.
+        '''
+        if not SUGGEST_DEADLINE:
+            return await super().query_es(url, body)
+        futures = [gen.convert_yielded(
+                       self.fetch_es(url, self.msearch_body((name,)), (name,)))
+                   for name in self.subqueries]
+        try:
+            await gen.with_timeout(timedelta(seconds=SUGGEST_DEADLINE),
+                                   [settle(future) for future in futures])
+        except gen.TimeoutError:
+            pass
+        responses, details = [], []
+        for name, future in zip(self.subqueries, futures):
+            if future.done() and future.exception() is None:
+                data, timings = future.result()
+                responses.extend(data['responses'])
+                details.extend(timings)
+            else:
+                responses.append(None)
+                self.incomplete.add(name)
+        start = monotonic()
+        try:
+            result = await self.transform({'responses': responses})
+        finally:
+            transform = monotonic() - start
+            metrics.TRANSFORM_TIME.observe(transform, type(self).__name__)
+        return result, details + [('transform', transform)]
+
+    async def transform(self, data):
+        r = self.add_responses(data)
+        if r is None:
+            return None
+        return self.cached(await OFFLOAD.run(self.response_size, build_suggestions, r))
+
+    def add_responses(self, data):
+        '''
+        Add the sub-responses of the _msearch to those found so far.
+        Returns all the sub-responses, or None if the next tier is needed.
+        '''
+        self.responses.update((name, response) for name, response
+                              in zip(self.subqueries, data['responses'])
+                              if response is not None)
+        if self.next_tier and suggestion_count(self.responses) < SUGGEST_TIER_MIN:
+            return None
+        infix = queries.SUGGEST_NAMES[:7]
+        if (self.candidates is None and self.geo is None and
+                all(name in self.responses for name in infix)):
+            SUGGEST_CANDIDATES.add(self.search_term, self.cities_key,
+                                   [self.responses[name] for name in infix])
+        return [self.responses.get(name) or empty_response(name)
+                for name in queries.SUGGEST_NAMES]
+
+    def suggestions(self, r):
+        '''Build and cache the response from the sub-responses of the _msearch.'''
+        return self.cached(build_suggestions(r))
+
+    def cached(self, result):
+        '''Cache a complete response, or list the sections missing from it.'''
+        if self.incomplete:
+            # Not cached, so that the next request may get all the sections
+            result['incomplete'] = sorted({section(name) for name in self.incomplete})
+        else:
+            SUGGEST_CACHE.put(self.cache_key, result)
+        return result
+
+
+def build_suggestions(r):
+    '''
+    The suggest response from the sub-responses of the _msearch. A
+    function of its own, so that it can run in a process pool.
+    '''
+    streetnames_fi = []
+    for s in r[0]["aggregations"]["streets"]["buckets"]:
+        streetnames_fi.append({s["key"]: s["cities"]["buckets"]})
+    streetnames_sv = []
+    for s in r[1]["aggregations"]["streets"]["buckets"]:
+        streetnames_sv.append({s["key"]: s["cities"]["buckets"]})
+    stops = {}
+    for s in (r[2]["hits"]["hits"] + r[3]["hits"]["hits"] +
+              r[4]["hits"]["hits"] + r[5]["hits"]["hits"] + r[6]["hits"]["hits"]):
+        if s["_id"] not in stops:  # A stop might match in multiple searches
+            # The source may be kept as a prefix candidate, so copy it
+            new_stop = dict(s["_source"])
+            # Rename some fields
+            for rename in [('NAME_FI', 'nameFi'),
+                           ('NAME_SV', 'nameSv'),
+                           ('STOP_CODE', 'stopCode'),
+                           ('ADDRESS', 'address'),
+                           ('MUNICIPALITY_NAME', 'municipalityFi'),
+                           ('COMMENTS', 'stopDesc')]:
+                new_stop[rename[1]] = new_stop[rename[0]]
+                del new_stop[rename[0]]
+
+            stops[s["_id"]] = new_stop
+    result = {
+        # Address is a single key/value dict, where the streetname is the key.
+        # In Python3 it's a bit tricky to get that key:
+        # dict_keys -> iterator -> value
+        'streetnames_fi': sorted(streetnames_fi,
+                                 key=lambda x: x.keys().__iter__().__next__()),
+        'streetnames_sv': sorted(streetnames_sv,
+                                 key=lambda x: x.keys().__iter__().__next__()),
+        'stops': sorted(list(stops.values()),
+                        key=lambda x: x['nameFi'] + x['stopDesc']),
+        'fuzzy_streetnames': r[7]["aggregations"]["streets"]["buckets"],
+    }
+    return result
 
 
 class ReverseHandler(Handler):
+    hedge = True
+    endpoint = 'reverse'
 
     def initialize(self):
         pass
 
-    @asynchronous
-    def get(self, **kwargs):
+    async def get(self, **kwargs):
         """
         Reverse geocoding request -- get the nearest city or address for given coordinates.
 
@@ -579,50 +1125,29 @@ class ReverseHandler(Handler):
              "location" : [24.5038823316986, 60.3216807160152]}
         """
         if 'city' not in self.request.arguments:
-            url = "address/_search?pretty&size=1"
-            template = Template('''{
-                 "sort" : [{"_geo_distance" : {
-                                "location": {
-                                    "lat":  {{ lat }},
-                                    "lon": {{ lon }}
-                                },
-                                "order" : "asc",
-                                "unit" : "km",
-                                "mode" : "min",
-                                "distance_type" : "plane"
-                                } }] }''')
+            if NEAREST_ADDRESS_INDEX is not None:
+                address = NEAREST_ADDRESS_INDEX.nearest(float(kwargs['lat']),
+                                                        float(kwargs['lon']))
+                if address is None:
+                    raise HTTPError(404)
+                self.write(address)
+                finish_request(self)
+                return
+            await super().get("address/_search?pretty&size=1",
+                              queries.REVERSE_ADDRESS.render(kwargs))
         else:
             # When the user hasn't zoomed in, there's no hope in pinpointing
             # addresses accurately. So instead, we return municipalities.
-            url = "municipality/_search?pretty&size=1"
-            # Addresses have geo_points, but municipalities geo_shapes.
-            # The shapes cannot be used in distance queries or sorting,
-            # so we check whether a point shape intersects (ES default,
-            # but here explicitly) with the municipality boundaries.
-            template = Template('''{
-            "query": {
-                "filtered": {
-                  "filter": {
-                    "geo_shape": {
-                      "boundaries": {
-                        "relation": "intersects",
-                        "shape": {
-                          "coordinates": [
-                            {{ lon }},
-                            {{ lat }}
-                          ],
-                          "type": "point"
-                        }
-                      }
-                    }
-                  }
-                }
-            }}''')
-
-        AsyncHTTPClient().fetch(ES_URL + url,
-                                allow_nonstandard_methods=True,
-                                body=template.render(kwargs),
-                                callback=self.on_response)
+            if MUNICIPALITY_INDEX is not None:
+                municipality = MUNICIPALITY_INDEX.find(float(kwargs['lat']),
+                                                       float(kwargs['lon']))
+                if municipality is None:
+                    raise HTTPError(404)
+                self.write(municipality)
+                finish_request(self)
+                return
+            await super().get("municipality/_search?pretty&size=1",
+                              queries.REVERSE_CITY.render(kwargs))
 
     def transform_es(self, data):
         if not data['hits']['hits']:
@@ -630,13 +1155,79 @@ class ReverseHandler(Handler):
         return data["hits"]["hits"][0]["_source"]
 
 
+class BatchReverseHandler(RequestHandler):
+    '''RequestHandler for reverse geocoding many points in one request.'''
+
+    def post(self):
+        '''
+        Get the nearest addresses, or with the city parameter the
+        municipalities, for up to 100000 points (configurable) at once.
+        Requires the app to be started with ``--in-memory reverse`` or
+        ``--in-memory municipalities`` respectively.
+
+        The points are given either as a JSON object::
+
+            {"points": [[60.17586, 24.93369], [60.1841593, 24.9494081]]}
+
+        or with Content-Type application/octet-stream as a little endian
+        array of 64-bit floats, latitude and longitude for each point.
+
+        The results are in the same order as the points, in the format of
+        the reverse endpoint, except that municipalities don't include their
+        boundaries. A point outside all municipalities has the result null.
+
+        :query city: If given, return the cities at given coordinates. If not, return nearest addresses.
+        :status 400: if the points are malformed or there are too many of them
+        :status 503: if the needed in-memory index was not loaded
+
+        Example response::
+
+            {"results": [
+                {"kaupunki" : "Helsinki",
+                 "katunimi" : "Mannerheimintie",
+                 ...},
+                ...
+            ]}
+        '''
+        try:
+            if self.request.headers.get('Content-Type', '').startswith(
+                    'application/octet-stream'):
+                points = np.frombuffer(self.request.body, dtype='<f8').reshape((-1, 2))
+            else:
+                points = np.array(
+                    json.loads(self.request.body.decode('utf-8'))['points'],
+                    dtype=np.float64).reshape((-1, 2))
+        except (ValueError, KeyError, TypeError):
+            raise HTTPError(400)
+        if len(points) > BATCH_REVERSE_LIMIT:
+            raise HTTPError(400)
+
+        if 'city' in self.request.arguments:
+            if MUNICIPALITY_INDEX is None:
+                raise HTTPError(503, "Municipalities are not loaded in memory")
+            municipalities = MUNICIPALITY_INDEX.municipalities
+            results = [None if i < 0 else
+                       {k: v for k, v in municipalities[i].items() if k != 'boundaries'}
+                       for i in MUNICIPALITY_INDEX.find_indexes(points[:, 0],
+                                                                points[:, 1]).tolist()]
+        else:
+            if NEAREST_ADDRESS_INDEX is None:
+                raise HTTPError(503, "Addresses are not loaded in memory")
+            addresses = NEAREST_ADDRESS_INDEX.addresses
+            results = [None if i < 0 else addresses[i]
+                       for i in NEAREST_ADDRESS_INDEX.nearest_indexes(
+                           points[:, 0], points[:, 1]).tolist()]
+        self.write({'results': results})
+        finish_request(self)
+
+
 class InterpolateHandler(Handler):
     '''RequestHandler for coordinates interpolated from NLS data.'''
+    endpoint = 'interpolate'
     def initialize(self):
         pass
 
-    @asynchronous
-    def get(self, streetname, streetnumber):
+    async def get(self, streetname, streetnumber):
         """
         Request a location of address only known by interpolation.
 
@@ -664,45 +1255,45 @@ class InterpolateHandler(Handler):
 
         """
         self.streetnumber = int(streetnumber)
+        if ROAD_INDEX is not None:
+            coordinates = ROAD_INDEX.interpolate(streetname, self.streetnumber)
+            if coordinates is None:
+                raise HTTPError(404)
+            self.write({'coordinates': coordinates})
+            finish_request(self)
+            return
         if self.streetnumber % 2 == 0:
             self.side = "vasen"
         else:
             self.side = "oikea"
-        url = "interpolated_address/_search?pretty&size=10"
-        template = Template('''{
-                 "query": { "filtered": {
-                     "filter": {
-                         "bool" : {
-                             "must" : [
-                                 {"term": {"nimi": "{{ streetname.lower() }}"}},
-                                 {"range":
-                                    {"min_{{ side }}": {"lte" : {{ streetnumber }} }}},
-                                 {"range":
-                                    {"max_{{ side }}": {"gte" : {{ streetnumber }} }}}]}
-
-              }}}}''')
-        AsyncHTTPClient().fetch(ES_URL + url,
-                                allow_nonstandard_methods=True,
-                                body=template.render({'streetname': streetname,
-                                                      'streetnumber': streetnumber,
-                                                      'side': self.side}),
-                                callback=self.on_response)
+        await super().get("interpolated_address/_search?pretty&size=10",
+                          queries.INTERPOLATE.render(streetname=streetname,
+                                                     streetnumber=streetnumber,
+                                                     side=self.side))
 
-    def transform_es(self, data):
+    async def transform(self, data):
         if data["hits"]["hits"]:
             street = data["hits"]["hits"][0]["_source"]
-            if street["max_" + self.side][0] == street["min_" + self.side][0]:
-                fraction = 0.5
-            else:
-                fraction = (self.streetnumber - int(street["min_" + self.side][0])) / \
-                           (int(street["max_" + self.side][0]) - int(street["min_" + self.side][0]))
-            return {'coordinates':
-                    list(LineString(street['location']['coordinates'])
-                         .interpolate(fraction, normalized=True).coords)[0]}
+            return {'coordinates': await OFFLOAD.run(
+                self.response_size, interpolate, street, self.streetnumber, self.side)}
         raise HTTPError(404)
 
 
-def make_app(settings={}, path='../docs/_build/html/'):
+def interpolate(street, streetnumber, side):
+    '''
+    Coordinates of streetnumber on the side of an interpolated_address
+    road segment. A function of its own, so that it can run in a process pool.
+    '''
+    if street["max_" + side][0] == street["min_" + side][0]:
+        fraction = 0.5
+    else:
+        fraction = (streetnumber - int(street["min_" + side][0])) / \
+                   (int(street["max_" + side][0]) - int(street["min_" + side][0]))
+    return list(LineString(street['location']['coordinates'])
+                .interpolate(fraction, normalized=True).coords)[0]
+
+
+def make_app(settings={}, path='../docs/_build/html/', compress=True):
     return Application(
         [URLSpec(r"/suggest/(?P<search_term>[\w\-%()\.']*)",
                  SuggestHandler),
@@ -711,22 +1302,78 @@ def make_app(settings={}, path='../docs/_build/html/'):
                  AddressSearchHandler),
          URLSpec(r"/street/(?P<city>[\w\-%]*)/(?P<streetname>[\w\-%()\.']*)",
                  StreetSearchHandler),
+         URLSpec(r"/batch/address",
+                 BatchAddressHandler),
+         URLSpec(r"/batch/reverse",
+                 BatchReverseHandler),
          URLSpec(r"/interpolate/(?P<streetname>[\w\-%()\.']*)/(?P<streetnumber>[\w\-%]*)",
                  InterpolateHandler),
          URLSpec(r"/reverse/(?P<lat>\d+\.\d+),(?P<lon>\d+\.\d+)",
                  ReverseHandler),
          URLSpec(r"/meta",
                  MetaHandler),
+         URLSpec(r"/stats",
+                 StatsHandler),
+         URLSpec(r"/metrics",
+                 MetricsHandler),
          URLSpec(r"/(.*)",
                  StaticFileHandler,
                  {"path": path,
                   "default_filename": "index.html"})],
+        transforms=compression.transforms(compress),
+        log_function=log_request,
         **settings)
 
 
 app = make_app()
 
 
+def use_event_loop(name):
+    '''
+    Run the IOLoop of this process on asyncio, optionally with the
+    uvloop event loop, or on tornado's own. Call before anything uses
+    the IOLoop.
+    '''
+    if name == 'tornado':
+        return
+    if name == 'uvloop':
+        asyncio.set_event_loop(uvloop.new_event_loop())
+    else:
+        asyncio.set_event_loop(asyncio.new_event_loop())
+    AsyncIOMainLoop().install()
+
+
+def load_index(loader):
+    '''
+    Load an in-memory index from ElasticSearch. If loading fails,
+    log the error and return None so that ES is queried instead.
+    '''
+    try:
+        return loader(ES.url)
+    except Exception:  # pylint: disable=broad-except
+        logging.exception("Could not load in-memory index, using ElasticSearch")
+        return None
+
+
+def parse_cache_control(value):
+    '''Parse a --cache-control value into (endpoint, header value).'''
+    name, _, cache_control = value.partition(':')
+    if name not in CACHEABLE or not cache_control:
+        raise click.BadParameter("%s is not ENDPOINT:CACHE-CONTROL" % value)
+    return name, cache_control.strip()
+
+
+def parse_admission(value):
+    '''Parse an --admission value into (endpoint, limit, queue size).'''
+    try:
+        name, limit, queue_size = value.split(':')
+        if name not in admission.PRIORITIES:
+            raise ValueError(name)
+        return name, int(limit) if limit else None, int(queue_size)
+    except ValueError:
+        raise click.BadParameter("%s is not ENDPOINT:LIMIT:QUEUE" % value)
+
+
 @click.command()
 @click.option('--docs', help="The directory containing API docs",
               default='../docs/_build/html/', show_default=True)
@@ -734,18 +1381,188 @@ app = make_app()
               default=8888, show_default=True)
 @click.option("-v", "--verbose", count=True, help="Use once for info, twice for more")
 @click.option("-d", "--date", help="The metadata updated date")
-def main(docs, port=8888, verbose=0, date=None):
-    global DATE, app
+@click.option('--suggest-cache-size', default=10000, show_default=True,
+              help="Number of suggest responses and prefix candidates to cache, "
+                   "0 disables caching")
+@click.option('--suggest-cache-ttl', default=300, show_default=True,
+              help="Seconds to cache a suggest response")
+@click.option('--suggest-ngram/--suggest-wildcard', default=True, show_default=True,
+              help="Search the n-gram subfields, or use wildcard queries "
+                   "with indexes imported without them")
+@click.option('--suggest-tiered/--suggest-all', default=False, show_default=True,
+              help="Search stop descriptions, addresses and typo fixes only "
+                   "when names and stop codes give too few suggestions")
+@click.option('--suggest-tier-min', default=SIZE, show_default=True,
+              help="Fewest streets and stops found by the first tier of "
+                   "--suggest-tiered that skips the second")
+@click.option('--suggest-deadline', default=0.0, show_default=True,
+              help="Send the suggest sub-queries as separate requests and "
+                   "respond with what they found in this many seconds, "
+                   "0 to send them in one _msearch")
+@click.option('--batch-limit', default=1000, show_default=True,
+              help="Maximum number of items in one batch request")
+@click.option('--batch-reverse-limit', default=100000, show_default=True,
+              help="Maximum number of points in one batch reverse geocoding request")
+@click.option('--es-url', multiple=True, default=[es_client.ES_URL], show_default=True,
+              help="URL of the ElasticSearch index. Give multiple times "
+                   "to spread the queries between several nodes.")
+@click.option('--es-routing', type=click.Choice(es_client.ROUTINGS),
+              default='round-robin', show_default=True,
+              help="How to choose the ElasticSearch node for a query")
+@click.option('--es-max-failures', default=es_client.MAX_FAILURES, show_default=True,
+              help="Consecutive failed or slow queries after which "
+                   "an ElasticSearch node is left out")
+@click.option('--es-eject-time', default=es_client.EJECT_TIME, show_default=True,
+              help="Seconds to leave out a failed ElasticSearch node")
+@click.option('--es-slow', default=0.0, show_default=True,
+              help="Seconds after which a query counts as failed "
+                   "for the health check, 0 to disable")
+@click.option('--es-hedge', is_flag=True,
+              help="Send suggest and reverse queries also to another "
+                   "ElasticSearch node if the first hasn't answered "
+                   "within the 95th percentile latency")
+@click.option('--es-max-clients', default=es_client.MAX_CLIENTS, show_default=True,
+              help="Maximum number of simultaneous requests to ElasticSearch")
+@click.option('--es-keep-alive/--no-es-keep-alive', default=True, show_default=True,
+              help="Reuse connections to ElasticSearch, needs --es-curl")
+@click.option('--es-curl', is_flag=True,
+              help="Use the pycurl based HTTP client for ElasticSearch")
+@click.option('--es-connect-timeout', default=2.0, show_default=True,
+              help="Seconds to wait for a connection to ElasticSearch")
+@click.option('--es-request-timeout', default=20.0, show_default=True,
+              help="Seconds to wait for a response from ElasticSearch")
+@click.option('--workers', default=1, show_default=True,
+              help="Number of worker processes, 0 for one per CPU")
+@click.option('--shutdown-timeout', default=10.0, show_default=True,
+              help="Seconds to wait for queries in progress when stopping")
+@click.option('--metrics-port', type=int,
+              help="Also serve /metrics and /stats from this port, "
+                   "plus the worker id with --workers")
+@click.option('--slow-query-time', default=0.0, show_default=True,
+              help="Log the ES queries of requests slower than this many "
+                   "seconds, 0 to disable")
+@click.option('--slow-query-log', type=click.Path(dir_okay=False),
+              help="File to write the slow queries to, instead of the main log")
+@click.option('--slow-query-profile', is_flag=True,
+              help="Also send slow queries again with profiling and log the ES profile. "
+                   "Needs ES 2.2 or later, older versions reject the profiled query")
+@click.option('--admission', 'admission_limits', multiple=True, metavar='ENDPOINT:LIMIT:QUEUE',
+              help="Limit the simultaneous ES queries of an endpoint, one of %s, "
+                   "and the number of requests waiting for their turn. "
+                   "Can be given multiple times." % ', '.join(sorted(admission.PRIORITIES)))
+@click.option('--admission-total', default=admission.TOTAL, show_default=True,
+              help="Limit of simultaneous ES queries from all endpoints, 0 for none")
+@click.option('--admission-timeout', default=admission.TIMEOUT, show_default=True,
+              help="Seconds a request may wait for its turn, 0 for no limit")
+@click.option('--retry-after', default=admission.RETRY_AFTER, show_default=True,
+              help="Retry-After seconds for requests rejected because of overload")
+@click.option('--compress/--no-compress', default=True, show_default=True,
+              help="Compress responses with brotli or gzip for clients that "
+                   "accept them. Brotli needs the brotli package.")
+@click.option('--cache-control', multiple=True, metavar='ENDPOINT:VALUE',
+              help="Cache-Control header of the responses of an endpoint, "
+                   "one of %s, for example \"suggest:public, max-age=3600\". "
+                   "Can be given multiple times." % ', '.join(CACHEABLE))
+@click.option('--executor', type=click.Choice(offload.EXECUTORS), default='none',
+              show_default=True,
+              help="Decode and transform large ES responses in a thread or "
+                   "process pool instead of the IOLoop")
+@click.option('--executor-workers', default=0, show_default=True,
+              help="Threads or processes of the --executor, 0 for one per CPU")
+@click.option('--offload-size', default=offload.MIN_SIZE, show_default=True,
+              help="Bytes of ES response from which the --executor is used")
+@click.option('--event-loop', type=click.Choice(EVENT_LOOPS), default='asyncio',
+              show_default=True,
+              help="Run on asyncio, on asyncio with the faster uvloop, "
+                   "which needs the uvloop package, or on tornado's own IOLoop")
+@click.option('--in-memory', multiple=True,
+              type=click.Choice(['addresses', 'reverse', 'municipalities', 'roads', 'suggest']),
+              help="Load data into memory at startup to answer requests "
+                   "without ElasticSearch. Can be given multiple times.")
+def main(docs, port=8888, verbose=0, date=None,
+         suggest_cache_size=10000, suggest_cache_ttl=300, suggest_ngram=True,
+         suggest_tiered=False, suggest_tier_min=SIZE, suggest_deadline=0.0,
+         batch_limit=1000,
+         batch_reverse_limit=100000, es_url=(es_client.ES_URL,),
+         es_routing='round-robin', es_max_failures=es_client.MAX_FAILURES,
+         es_eject_time=es_client.EJECT_TIME, es_slow=0.0, es_hedge=False,
+         es_max_clients=es_client.MAX_CLIENTS, es_keep_alive=True, es_curl=False,
+         es_connect_timeout=2.0, es_request_timeout=20.0, workers=1,
+         shutdown_timeout=10.0, metrics_port=None, slow_query_time=0.0,
+         slow_query_log=None, slow_query_profile=False, admission_limits=(),
+         admission_total=100, admission_timeout=5.0, retry_after=1, compress=True,
+         cache_control=(), executor='none', executor_workers=0,
+         offload_size=offload.MIN_SIZE, event_loop='asyncio', in_memory=()):
+    global DATE, WORKER_ID, BATCH_LIMIT, BATCH_REVERSE_LIMIT, app
+    global SLOW_QUERY_TIME, SLOW_QUERY_PROFILE, SUGGEST_NGRAM
+    global SUGGEST_TIERED, SUGGEST_TIER_MIN, SUGGEST_DEADLINE
+    global ADDRESS_INDEX, NEAREST_ADDRESS_INDEX, MUNICIPALITY_INDEX, ROAD_INDEX
+    global SUGGEST_INDEX
     settings = {}
     if verbose == 1:
         logging.basicConfig(level=logging.INFO)
     elif verbose == 2:
         logging.basicConfig(level=logging.DEBUG)
         settings = {'debug': True}
-    app = make_app(settings, path=docs)
+    if workers != 1:
+        # Reloading would restart each worker as a whole new server
+        settings['autoreload'] = False
+    if event_loop == 'uvloop' and uvloop is None:
+        raise click.BadParameter("uvloop is not installed", param_hint='--event-loop')
 
     DATE = date
-    app.listen(port)
+    BATCH_LIMIT = batch_limit
+    BATCH_REVERSE_LIMIT = batch_reverse_limit
+    SUGGEST_NGRAM = suggest_ngram
+    SUGGEST_TIERED = suggest_tiered
+    SUGGEST_TIER_MIN = suggest_tier_min
+    SUGGEST_DEADLINE = suggest_deadline or None
+    CACHE_CONTROL.clear()
+    CACHE_CONTROL.update(parse_cache_control(value) for value in cache_control)
+    ADMISSION.configure(admission_total, admission_timeout, retry_after,
+                        [parse_admission(a) for a in admission_limits])
+    SLOW_QUERY_TIME = slow_query_time or None
+    SLOW_QUERY_PROFILE = slow_query_profile
+    if slow_query_log:
+        handler = logging.FileHandler(slow_query_log)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(process)d %(message)s'))
+        SLOW_QUERY_LOG.addHandler(handler)
+        SLOW_QUERY_LOG.propagate = False
+    SUGGEST_CACHE.configure(suggest_cache_size, suggest_cache_ttl)
+    SUGGEST_CANDIDATES.configure(suggest_cache_size, suggest_cache_ttl)
+    ES.configure(es_url, es_max_clients, es_keep_alive, es_curl,
+                 es_connect_timeout, es_request_timeout, es_routing,
+                 es_max_failures, es_eject_time, es_slow or None, es_hedge)
+    if 'addresses' in in_memory:
+        ADDRESS_INDEX = load_index(address_index.load)
+    if 'reverse' in in_memory:
+        NEAREST_ADDRESS_INDEX = load_index(reverse_index.load)
+    if 'municipalities' in in_memory:
+        MUNICIPALITY_INDEX = load_index(municipality_index.load)
+    if 'roads' in in_memory:
+        ROAD_INDEX = load_index(road_index.load)
+    if 'suggest' in in_memory:
+        SUGGEST_INDEX = load_index(suggest_index.load)
+
+    # The indexes are loaded and the port bound before forking,
+    # so the workers share them. Each worker has an event loop of its own,
+    # and the autoreloader of the application starts using it.
+    sockets = bind_sockets(port)
+    if workers != 1:
+        WORKER_ID = prefork.fork(workers)
+    use_event_loop(event_loop)
+    # Each worker has pools of its own
+    OFFLOAD.configure(executor, executor_workers, offload_size)
+    LAG_MONITOR.start()
+    app = make_app(settings, path=docs, compress=compress)
+    server = HTTPServer(app)
+    server.add_sockets(sockets)
+    if metrics_port:
+        # A port of its own for each worker, so that they can be scraped separately
+        Application([URLSpec(r"/metrics", MetricsHandler),
+                     URLSpec(r"/stats", StatsHandler)],
+                    log_function=log_request).listen(metrics_port + WORKER_ID)
+    prefork.stop_on_signals(server, shutdown_timeout, lambda: ES.in_flight)
     IOLoop.current().start()
 
 
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+'''In-process caches for the web API.'''
+from collections import OrderedDict
+from time import monotonic
+
+from tornado.concurrent import Future
+
+
+class ResponseCache(object):
+    '''
+    Bounded LRU cache whose entries also expire after ttl seconds.
+
+    The cache remembers the data version its entries were computed from
+    and drops everything when a different version is given to
+    :meth:`set_version`, so responses never outlive a data update.
+    A size of 0 disables caching.
+    '''
+    def __init__(self, size=10000, ttl=300, clock=monotonic):
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def configure(self, size, ttl):
+        '''Change the limits, dropping the entries cached so far.'''
+        self.size = size
+        self.ttl = ttl
+        self.clear()
+
+    def set_version(self, version):
+        '''Flush the cache if the data version has changed.'''
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+    def clear(self):
+        self._entries.clear()
+
+    def get(self, key):
+        '''Return the cached value for key, or None if missing or expired.'''
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > self.clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        self._entries[key] = (self.clock() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        '''Counters for sizing the cache.'''
+        return {'size': len(self._entries),
+                'max_size': self.size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses}
+
+
+class SingleFlight(object):
+    '''
+    Share one pending Future between identical concurrent requests.
+
+    The first caller of :meth:`run` with a key starts the work, and later
+    callers with the same key get the same Future until it resolves,
+    including its exception. Nothing is remembered after that.
+
+    Callers may give up waiting. The work is told to stop only when all
+    of its callers have given up, and later callers start it anew.
+    '''
+    def __init__(self):
+        # Key -> [Future, callers still waiting, Future resolved when they're gone]
+        self.in_flight = {}
+        self.started = 0
+        self.coalesced = 0
+        self.abandoned = 0
+
+    def __len__(self):
+        return len(self.in_flight)
+
+    def run(self, key, start, cancelled=None):
+        '''
+        Future of start(abandoned) for key, or of the call already in
+        flight. cancelled is a Future resolved when this caller gives up,
+        or None if it never does. abandoned is a Future resolved when
+        every caller has given up.
+        '''
+        flight = self.in_flight.get(key)
+        if flight is not None:
+            self.coalesced += 1
+            flight[1] += 1
+        else:
+            self.started += 1
+            abandoned = Future()
+            flight = [start(abandoned), 1, abandoned]
+            self.in_flight[key] = flight
+            flight[0].add_done_callback(lambda f: self._finish(key, flight))
+        if cancelled is not None:
+            cancelled.add_done_callback(lambda f: self._leave(key, flight))
+        return flight[0]
+
+    def _finish(self, key, flight):
+        if self.in_flight.get(key) is flight:
+            del self.in_flight[key]
+
+    def _leave(self, key, flight):
+        '''A caller of flight gave up.'''
+        flight[1] -= 1
+        if flight[1] == 0 and not flight[0].done():
+            self.abandoned += 1
+            self._finish(key, flight)
+            flight[2].set_result(None)
+
+    def stats(self):
+        '''Counters for how much work was shared.'''
+        return {'in_flight': len(self.in_flight),
+                'started': self.started,
+                'coalesced': self.coalesced,
+                'abandoned': self.abandoned}
@@ -7,7 +7,8 @@ import click
 import pyelasticsearch
 from pyproj import Proj, transform
 
-from geocoder.utils import ES, INDEX, prepare_es
+from geocoder.ngram import STOP_FIELDS
+from geocoder.utils import ES, INDEX, NGRAM_FIELD, prepare_es
 
 # ETRS89 / ETRS-TM35FIN
 in_projision = Proj(init='epsg:3067')
@@ -41,10 +42,12 @@ def documents(csvfile):  # Elasticsearch calls records documents
 @click.command()
 @click.argument('cvsfilename', type=click.Path(exists=True))
 def main(cvsfilename):
-    prepare_es(((DOCTYPE,
-                 {"properties": {
-                     "location": {
-                         "type": "geo_point"}}}), ))
+    # The fields searched by the suggest endpoint keep their default
+    # analysis, with an n-gram subfield for infix search
+    infix_mapping = {"type": "string", "fields": {"ngram": NGRAM_FIELD}}
+    properties = {field: infix_mapping for field in STOP_FIELDS}
+    properties["location"] = {"type": "geo_point"}
+    prepare_es(((DOCTYPE, {"properties": properties}), ))
 
     # Currently Digiroad uses Microsoft standard of prepending UTF-8 text file with BOM.
     # The utf-8-sig encoding will remove it from the stream, if it's there.
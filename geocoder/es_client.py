@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+'''
+Shared Elasticsearch client for the web API handlers.
+
+All queries go through one ESClient, so the HTTP connection pool,
+timeouts and the ES nodes are configured in one place, and the pool
+usage can be followed to see when more connections are needed.
+
+With several ES nodes the requests are spread between them, nodes that
+keep failing or answering slowly are left out for a while, and
+optionally a request is sent again to another node if the first one
+has failed or hasn't answered within the 95th percentile latency.
+
+A request can be given a Future that resolves when its result is no
+longer needed, for example when the client of the web API has closed
+the connection. Nothing more is sent for it after that. A request
+already sent is left to finish, as ES keeps searching after the
+connection closes anyway, but its response is dropped.
+'''
+from collections import deque
+from datetime import timedelta
+import logging
+from time import monotonic
+
+from tornado import gen
+from tornado.concurrent import Future, chain_future
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPResponse
+from tornado.web import HTTPError
+
+ES_URL = "http://localhost:9200/reittiopas/"
+# Tornado's own default is 10, which queues requests long before ES is busy
+MAX_CLIENTS = 100
+ROUTINGS = ('round-robin', 'least-outstanding')
+# Consecutive failed requests after which a node is left out
+MAX_FAILURES = 3
+# Seconds to leave a failed node out
+EJECT_TIME = 10.0
+# Latencies of the latest successful requests, for the hedging delay
+LATENCY_SAMPLES = 1000
+# Don't hedge before there's enough data for a meaningful percentile
+MIN_LATENCY_SAMPLES = 20
+# New samples after which the percentile is computed again
+PERCENTILE_INTERVAL = 100
+
+
+class Cancelled(HTTPError):
+    '''499 for a request whose client closed the connection.'''
+    def __init__(self):
+        super().__init__(499, reason="Client Closed Request")
+
+
+def unless_cancelled(future, cancelled):
+    '''
+    Future of the result of future, or of a Cancelled error if the
+    cancelled Future resolves first. cancelled may be None.
+    '''
+    future = gen.convert_yielded(future)
+    if cancelled is None:
+        return future
+    result = Future()
+    chain_future(future, result)
+
+    def cancel(_):
+        if not result.done():
+            result.set_exception(Cancelled())
+            # Nobody waits for it anymore, so don't log its failure
+            future.add_done_callback(lambda f: f.exception())
+    cancelled.add_done_callback(cancel)
+    return result
+
+
+def _keep_alive_options(keep_alive):
+    '''prepare_curl_callback for the keep-alive setting.'''
+    import pycurl  # pylint: disable=import-error
+
+    def prepare(curl):
+        curl.setopt(pycurl.FORBID_REUSE, 0 if keep_alive else 1)
+        curl.setopt(pycurl.TCP_KEEPALIVE, 1 if keep_alive else 0)
+    return prepare
+
+
+def _failed(response):
+    '''Server errors and responses that never came, which have status 599.'''
+    return response.code >= 500
+
+
+class Node(object):
+    '''An ES index URL and its passive health check state.'''
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        # Consecutive failures, reset by a successful request
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.ejections = 0
+
+    def stats(self, now):
+        return {'url': self.url,
+                'outstanding': self.outstanding,
+                'requests': self.requests,
+                'errors': self.errors,
+                'ejected': self.ejected_until > now,
+                'ejections': self.ejections}
+
+
+class ESClient(object):
+    '''
+    Sends requests to Elasticsearch nodes with a bounded pool of connections.
+
+    With ``curl=True`` the pycurl based client is used, which reuses
+    connections to ES between requests. Tornado's simple client opens a
+    new connection for every request, so ``keep_alive`` only has an
+    effect with curl.
+
+    A node is ejected for ``eject_time`` seconds after ``max_failures``
+    consecutive requests to it have failed or, if ``slow`` is given,
+    taken longer than ``slow`` seconds. If every node is ejected, the
+    one ejected first is used anyway.
+    '''
+    def __init__(self, urls=(ES_URL,), max_clients=MAX_CLIENTS, keep_alive=True,
+                 curl=False, connect_timeout=2.0, request_timeout=20.0,
+                 routing='round-robin', max_failures=MAX_FAILURES,
+                 eject_time=EJECT_TIME, slow=None, hedge=False, clock=monotonic):
+        self.nodes = [Node(url) for url in urls]
+        self.max_clients = max_clients
+        self.keep_alive = keep_alive
+        self.curl = curl
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.routing = routing
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self.slow = slow
+        self.hedge = hedge
+        self.clock = clock
+        self._prepare_curl = _keep_alive_options(keep_alive) if curl else None
+        self._next = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._p95 = None
+        self._new_samples = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+        # Requests that had to wait for a free connection
+        self.queued = 0
+        self.errors = 0
+        # Timeouts and refused connections, which have no HTTP status
+        self.connection_errors = 0
+        self.hedged = 0
+        # Hedged requests answered first by the second node
+        self.hedge_wins = 0
+
+    def configure(self, urls=(ES_URL,), max_clients=MAX_CLIENTS, keep_alive=True,
+                  curl=False, connect_timeout=2.0, request_timeout=20.0,
+                  routing='round-robin', max_failures=MAX_FAILURES,
+                  eject_time=EJECT_TIME, slow=None, hedge=False):
+        '''
+        Change the settings and configure the tornado HTTP client, which is
+        shared by all users of AsyncHTTPClient in the process. Call before
+        the IOLoop starts.
+        '''
+        self.__init__(urls, max_clients, keep_alive, curl, connect_timeout,
+                      request_timeout, routing, max_failures, eject_time, slow,
+                      hedge, self.clock)
+        if curl:
+            AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient",
+                                      max_clients=max_clients)
+        else:
+            AsyncHTTPClient.configure(None, max_clients=max_clients)
+
+    @property
+    def url(self):
+        '''URL of the first node, for requests that don't need routing.'''
+        return self.nodes[0].url
+
+    def choose(self, exclude=None):
+        '''The node to send the next request to.'''
+        now = self.clock()
+        nodes = [n for n in self.nodes if n is not exclude] or self.nodes
+        healthy = [n for n in nodes if n.ejected_until <= now]
+        if not healthy:
+            return min(nodes, key=lambda n: n.ejected_until)
+        self._next += 1
+        start = self._next % len(healthy)
+        if self.routing == 'least-outstanding':
+            # Start from a rotating position, so that ties are spread evenly
+            return min(healthy[start:] + healthy[:start], key=lambda n: n.outstanding)
+        return healthy[start]
+
+    def p95(self):
+        '''95th percentile of the recent successful latencies, or None.'''
+        if len(self.latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        if self._p95 is None or self._new_samples >= PERCENTILE_INTERVAL:
+            ordered = sorted(self.latencies)
+            self._p95 = ordered[int(len(ordered) * 0.95)]
+            self._new_samples = 0
+        return self._p95
+
+    async def fetch(self, path, body=None, hedge=False, raise_error=True,
+                    cancelled=None, **kwargs):
+        '''
+        Send a request to path under the ES index URL, with the same
+        arguments and return value as AsyncHTTPClient.fetch.
+
+        If hedge is true and hedging is enabled, the request is sent
+        again to another node if the first one is slow to answer,
+        and the first good response is returned.
+
+        Raises Cancelled instead if the cancelled Future resolves before
+        the response is returned.
+        '''
+        kwargs.setdefault('connect_timeout', self.connect_timeout)
+        kwargs.setdefault('request_timeout', self.request_timeout)
+        if self.curl:
+            kwargs.setdefault('prepare_curl_callback', self._prepare_curl)
+        if cancelled is not None and cancelled.done():
+            raise Cancelled()
+        if hedge and self.hedge and len(self.nodes) > 1:
+            response = await self._hedged(path, body, kwargs, cancelled)
+        else:
+            response = await self._send(self.choose(), path, body, kwargs)
+        if cancelled is not None and cancelled.done():
+            raise Cancelled()
+        if raise_error and response.error:
+            raise response.error
+        return response
+
+    async def _hedged(self, path, body, kwargs, cancelled):
+        node = self.choose()
+        first = gen.convert_yielded(self._send(node, path, body, kwargs))
+        delay = self.p95()
+        if delay is None:
+            return await first
+        try:
+            response = await gen.with_timeout(timedelta(seconds=delay), first)
+            # A node that is down fails at once, so try another one
+            if not _failed(response):
+                return response
+        except gen.TimeoutError:
+            pass
+        if cancelled is not None and cancelled.done():
+            return await first
+        self.hedged += 1
+        second = gen.convert_yielded(
+            self._send(self.choose(exclude=node), path, body, kwargs))
+        waiter = gen.WaitIterator(first, second)
+        while not waiter.done():
+            response = await waiter.next()
+            if not _failed(response):
+                if waiter.current_future is second:
+                    self.hedge_wins += 1
+                break
+        return response
+
+    async def _send(self, node, path, body, kwargs):
+        self.requests += 1
+        if self.in_flight >= self.max_clients:
+            self.queued += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        node.requests += 1
+        node.outstanding += 1
+        start = self.clock()
+        request = HTTPRequest(node.url + path, allow_nonstandard_methods=True,
+                              body=body, **kwargs)
+        try:
+            response = await AsyncHTTPClient().fetch(request, raise_error=False)
+        except Exception as e:  # pylint: disable=broad-except
+            # Since Tornado 6 raise_error=False only covers HTTP errors, and
+            # refused connections and timeouts are still raised
+            response = HTTPResponse(request, 599, error=e,
+                                    request_time=self.clock() - start)
+        finally:
+            self.in_flight -= 1
+            node.outstanding -= 1
+        self._record(node, response, self.clock() - start)
+        return response
+
+    def _record(self, node, response, elapsed):
+        '''Update the counters and the health of node after a response.'''
+        if response.error:
+            self.errors += 1
+            node.errors += 1
+            if response.code == 599:
+                self.connection_errors += 1
+        if _failed(response) or (self.slow and elapsed > self.slow):
+            node.failures += 1
+            if node.failures >= self.max_failures:
+                node.failures = 0
+                node.ejected_until = self.clock() + self.eject_time
+                node.ejections += 1
+                logging.warning("Leaving out ElasticSearch node %s for %s seconds",
+                                node.url, self.eject_time)
+        else:
+            node.failures = 0
+            self.latencies.append(elapsed)
+            self._new_samples += 1
+
+    def stats(self):
+        '''Counters for sizing the connection pool and following the nodes.'''
+        now = self.clock()
+        return {'max_clients': self.max_clients,
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+                'requests': self.requests,
+                'queued': self.queued,
+                'errors': self.errors,
+                'connection_errors': self.connection_errors,
+                'hedged': self.hedged,
+                'hedge_wins': self.hedge_wins,
+                'p95': self.p95(),
+                'nodes': [n.stats(now) for n in self.nodes]}
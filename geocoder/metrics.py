@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+'''
+Counters, gauges and histograms of the web API in the Prometheus text
+exposition format, for the /metrics endpoint.
+'''
+from bisect import bisect_left
+
+# Upper bounds in seconds, from a fast JSON decode to a slow ES query
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                             for name, value in zip(names, values))
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    '''
+    A named metric with one time series per combination of label values.
+
+    Values kept elsewhere can be read when rendering, with a collect
+    function returning a dict of label value tuples to values.
+    '''
+    kind = None
+
+    def __init__(self, name, documentation, labels=(), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.collect = collect
+        self.series = {}
+
+    def samples(self):
+        '''(name suffix, label names, label values, value) tuples.'''
+        if self.collect is not None:
+            self.series = self.collect()
+        for values, value in sorted(self.series.items()):
+            yield '', self.labels, values, value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, names, values, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix,
+                                        _format_labels(names, values),
+                                        _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *values, amount=1):
+        self.series[values] = self.series.get(values, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *values):
+        self.series[values] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, *values):
+        series = self.series.get(values)
+        if series is None:
+            # Count per bucket, sum and count
+            series = self.series[values] = [[0] * len(self.buckets), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def samples(self):
+        names = self.labels + ('le',)
+        for values, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield '_bucket', names, values + (_format_value(bound),), cumulative
+            yield '_sum', self.labels, values, total
+            yield '_count', self.labels, values, count
+
+
+class Registry(object):
+    '''The metrics rendered by the /metrics endpoint.'''
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return ''.join(metric.render() + '\n' for metric in self.metrics)
+
+
+REGISTRY = Registry()
+REQUESTS = REGISTRY.register(Counter(
+    'geocoder_requests_total', "Finished requests by handler and HTTP status.",
+    ('handler', 'status')))
+REQUEST_TIME = REGISTRY.register(Histogram(
+    'geocoder_request_duration_seconds', "Time to respond to a request.",
+    ('handler',)))
+ES_TIME = REGISTRY.register(Histogram(
+    'geocoder_es_duration_seconds',
+    "Round trip time of ElasticSearch queries, including waiting for a connection.",
+    ('handler',)))
+ES_TOOK = REGISTRY.register(Histogram(
+    'geocoder_es_took_seconds',
+    "Query time reported by ElasticSearch, the slowest in an _msearch.",
+    ('handler',)))
+DECODE_TIME = REGISTRY.register(Histogram(
+    'geocoder_decode_duration_seconds', "Time to decode ElasticSearch responses.",
+    ('handler',)))
+TRANSFORM_TIME = REGISTRY.register(Histogram(
+    'geocoder_transform_duration_seconds',
+    "Time to transform ElasticSearch responses into API responses.",
+    ('handler',)))
+ADMISSION_WAIT = REGISTRY.register(Histogram(
+    'geocoder_admission_wait_seconds',
+    "Time requests waited to be admitted to query ElasticSearch.",
+    ('endpoint',)))
+LOOP_LAG = REGISTRY.register(Histogram(
+    'geocoder_loop_lag_seconds',
+    "How late the IOLoop ran a periodic callback, the time it was blocked."))
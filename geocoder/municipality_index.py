@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+'''
+In-process point-in-polygon index of municipality boundaries
+for reverse geocoding cities.
+
+The boundaries are kept as prepared Shapely geometries behind an R-tree.
+Optionally a coarse raster grid is precomputed, where every cell that is
+completely inside one municipality answers directly, so only points in
+cells crossed by a border need the exact polygon test.
+'''
+import logging
+from math import floor
+
+import numpy as np
+import rtree
+import shapely
+from shapely.geometry import Point, box, shape
+from shapely.prepared import prep
+
+from geocoder import scroll
+
+# Raster cell size in degrees, or None for no raster
+GRID_SIZE = 0.1
+
+
+class MunicipalityIndex(object):
+    '''Municipality documents looked up by a point inside their boundaries.'''
+    def __init__(self, municipalities, grid_size=GRID_SIZE):
+        self.municipalities = []
+        self.shapes = []
+        self.geometries = []
+        # Storing the polygons separately is hugely more efficient compared to
+        # storing in index due to the pickling rtree does
+        p = rtree.index.Property()
+        # XXX 10/10/3 is better than the default 100/100/32, but perhaps not the best
+        p.index_capacity = 10
+        p.leaf_capacity = 10
+        p.near_minimum_overlap_factor = 3
+        self.rtree = rtree.index.Index(properties=p)
+        for i, m in enumerate(municipalities):
+            geometry = shape(m['boundaries'])
+            self.municipalities.append(m)
+            self.shapes.append(geometry)
+            self.geometries.append(prep(geometry))
+            # Speeds up the intersects_xy of find_indexes
+            shapely.prepare(geometry)
+            self.rtree.insert(i, geometry.bounds)
+
+        self.grid_size = grid_size
+        self.grid = {}
+        if grid_size and self.municipalities:
+            self._rasterize()
+
+    def __len__(self):
+        return len(self.municipalities)
+
+    def _rasterize(self):
+        '''Record the raster cells that are completely inside a municipality.'''
+        minx, miny, maxx, maxy = self.rtree.bounds
+        g = self.grid_size
+        for cx in range(int(floor(minx / g)), int(floor(maxx / g)) + 1):
+            for cy in range(int(floor(miny / g)), int(floor(maxy / g)) + 1):
+                cell = box(cx * g, cy * g, (cx + 1) * g, (cy + 1) * g)
+                for i in self.rtree.intersection(cell.bounds):
+                    if self.geometries[i].contains(cell):
+                        self.grid[(cx, cy)] = i
+                        break
+        logging.info("%i raster cells are inside a single municipality",
+                     len(self.grid))
+
+    def find_index(self, lat, lon):
+        '''Position of the municipality containing the point, or None.'''
+        if self.grid:
+            i = self.grid.get((int(floor(lon / self.grid_size)),
+                               int(floor(lat / self.grid_size))))
+            if i is not None:
+                return i
+        point = Point(lon, lat)
+        # Points on the border intersect, like in the ES geo_shape query.
+        # On a border between municipalities, the first one is chosen,
+        # like in find_indexes.
+        return min((i for i in self.rtree.intersection((lon, lat, lon, lat))
+                    if self.geometries[i].intersects(point)), default=None)
+
+    def find_indexes(self, lats, lons):
+        '''
+        Positions of the municipalities containing arrays of points,
+        or -1 for points outside all municipalities.
+        '''
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        result = np.full(len(lats), -1, dtype=np.int64)
+        if self.grid and len(lats):
+            cells = zip(np.floor(lons / self.grid_size).astype(np.int64).tolist(),
+                        np.floor(lats / self.grid_size).astype(np.int64).tolist())
+            result[:] = [self.grid.get(cell, -1) for cell in cells]
+        for i, geometry in enumerate(self.shapes):
+            minx, miny, maxx, maxy = geometry.bounds
+            candidates = np.flatnonzero((result < 0) &
+                                        (lons >= minx) & (lons <= maxx) &
+                                        (lats >= miny) & (lats <= maxy))
+            if len(candidates):
+                inside = shapely.intersects_xy(geometry, lons[candidates],
+                                               lats[candidates])
+                result[candidates[inside]] = i
+        return result
+
+    def find(self, lat, lon):
+        '''The municipality document containing the point, or None.'''
+        i = self.find_index(lat, lon)
+        return None if i is None else self.municipalities[i]
+
+
+def load(es_url):
+    '''Build a MunicipalityIndex from the municipality doctype in Elasticsearch.'''
+    index = MunicipalityIndex(scroll.documents(es_url, 'municipality'))
+    logging.info("Indexed %i municipalities", len(index))
+    return index
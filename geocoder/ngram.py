@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+'''
+Settings shared by the importers, which create the index, and the web
+API, which queries it.
+'''
+
+# Lengths of the n-grams indexed in the .ngram subfields of the searched
+# fields. Any substring of a name within these lengths is one term in the
+# index, so infix search is a term lookup instead of a leading wildcard
+# scanning every term.
+NGRAM_MIN = 2
+NGRAM_MAX = 20
+
+# Digiroad fields indexed with the n-grams and searched by the suggest
+# endpoint, in response order
+STOP_FIELDS = ('NAME_FI', 'NAME_SV', 'COMMENTS', 'STOP_CODE', 'ADDRESS')
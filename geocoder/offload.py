@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+'''
+Running CPU heavy work of the web API outside the IOLoop.
+
+Decoding large ES responses and transforming them into API responses
+blocks every other request served by the process. With an executor
+configured, the work on payloads of at least ``min_size`` bytes runs in
+a thread or process pool instead, and smaller payloads are handled
+right away, as handing them over would cost more than it saves.
+
+A thread pool shares the memory of the process, but pure Python code
+still takes turns with the IOLoop for the GIL. A process pool runs in
+parallel, but copies the arguments and the result between processes,
+so only module level functions of picklable arguments can be offloaded.
+
+How late the IOLoop runs a callback scheduled at a fixed interval shows
+how long it was blocked, with or without offloading.
+'''
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import os
+
+from tornado.concurrent import Future, chain_future
+from tornado.ioloop import IOLoop
+
+EXECUTORS = ('none', 'thread', 'process')
+# Bytes of ES response after which decoding and transforming is offloaded
+MIN_SIZE = 65536
+# Seconds between the checks of the IOLoop lag
+LAG_INTERVAL = 0.1
+
+
+class Offloader(object):
+    '''Runs functions in an executor when their payload is large enough.'''
+    def __init__(self, kind='none', workers=0, min_size=MIN_SIZE):
+        self.kind = kind
+        self.workers = workers or os.cpu_count() or 1
+        self.min_size = min_size
+        if kind == 'thread':
+            self.executor = ThreadPoolExecutor(self.workers)
+        elif kind == 'process':
+            self.executor = ProcessPoolExecutor(self.workers)
+        else:
+            self.executor = None
+        self.offloaded = 0
+        self.inline = 0
+
+    def configure(self, kind='none', workers=0, min_size=MIN_SIZE):
+        '''Change the settings. Call in the process that runs the IOLoop.'''
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.__init__(kind, workers, min_size)
+
+    async def run(self, size, fn, *args):
+        '''fn(*args), in the executor if size is at least min_size.'''
+        if self.executor is None or size < self.min_size:
+            self.inline += 1
+            return fn(*args)
+        self.offloaded += 1
+        result = Future()
+        # The executor's future resolves in another thread, so it is
+        # copied to the IOLoop's own future in the IOLoop thread
+        IOLoop.current().add_future(self.executor.submit(fn, *args),
+                                    lambda f: chain_future(f, result))
+        return await result
+
+    def stats(self):
+        return {'executor': self.kind,
+                'workers': self.workers if self.executor is not None else 0,
+                'min_size': self.min_size,
+                'offloaded': self.offloaded,
+                'inline': self.inline}
+
+
+class LagMonitor(object):
+    '''
+    Observes in histogram how many seconds late the IOLoop runs a
+    callback scheduled every interval seconds.
+    '''
+    def __init__(self, histogram, interval=LAG_INTERVAL):
+        self.histogram = histogram
+        self.interval = interval
+        self.max_lag = 0.0
+        self.io_loop = None
+        self.expected = None
+
+    def start(self):
+        '''Start measuring the lag of the current IOLoop.'''
+        self.io_loop = IOLoop.current()
+        self._schedule()
+
+    def _schedule(self):
+        self.expected = self.io_loop.time() + self.interval
+        self.io_loop.call_at(self.expected, self._check)
+
+    def _check(self):
+        lag = max(0.0, self.io_loop.time() - self.expected)
+        self.histogram.observe(lag)
+        self.max_lag = max(self.max_lag, lag)
+        self._schedule()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+'''
+Pre-forked worker processes for the web API, and graceful shutdown.
+
+The listening sockets are bound before forking, so all workers accept
+connections from the same sockets, and the in-memory indexes loaded
+before forking are shared copy-on-write.
+'''
+import logging
+import os
+import signal
+import sys
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.process import cpu_count
+
+MAX_RESTARTS = 100
+# Seconds between checks whether work is still in progress at shutdown
+POLL_INTERVAL = 0.1
+
+
+def fork(num_workers, max_restarts=MAX_RESTARTS):
+    '''
+    Start num_workers worker processes, or one per CPU if it's 0, and
+    return the id of the worker in each of them.
+
+    Like tornado.process.fork_processes, the parent process only restarts
+    workers that die and exits when all of them have exited. Unlike it,
+    the parent passes SIGTERM and SIGINT on to the workers, so that they
+    can shut down gracefully.
+    '''
+    if not num_workers:
+        num_workers = cpu_count()
+    children = {}
+    stopping = []
+
+    def start(worker_id):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            return worker_id
+        children[pid] = worker_id
+        return None
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    logging.info("Starting %i workers", num_workers)
+    for i in range(num_workers):
+        if start(i) is not None:
+            return i
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    restarts = 0
+    while children:
+        try:
+            pid, status = os.wait()
+        except InterruptedError:
+            continue
+        if pid not in children:
+            continue
+        worker_id = children.pop(pid)
+        if stopping or (os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0):
+            logging.info("Worker %i (pid %i) exited", worker_id, pid)
+            continue
+        logging.warning("Worker %i (pid %i) died with status %i, restarting",
+                        worker_id, pid, status)
+        restarts += 1
+        if restarts > max_restarts:
+            raise RuntimeError("Too many worker restarts, giving up")
+        if start(worker_id) is not None:
+            return worker_id
+    sys.exit(0)
+
+
+async def shutdown(server, timeout, busy):
+    '''
+    Stop accepting connections, wait up to timeout seconds while busy()
+    is true, and stop the IOLoop.
+    '''
+    server.stop()
+    io_loop = IOLoop.current()
+    deadline = io_loop.time() + timeout
+    idle = 0
+    # The responses are written some loop iterations after the work is done
+    while idle < 2 and io_loop.time() < deadline:
+        await gen.sleep(POLL_INTERVAL)
+        idle = 0 if busy() else idle + 1
+    io_loop.stop()
+
+
+def stop_on_signals(server, timeout, busy):
+    '''Shut down gracefully on SIGTERM and SIGINT.'''
+    io_loop = IOLoop.current()
+    stopping = []
+
+    def handler(signum, frame):
+        if stopping:
+            return
+        stopping.append(signum)
+        logging.info("Shutting down, pid %i", os.getpid())
+        io_loop.add_callback_from_signal(shutdown, server, timeout, busy)
+
+    signal.signal(signal.SIGTERM, handler)
+    signal.signal(signal.SIGINT, handler)
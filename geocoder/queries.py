@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+'''
+Elasticsearch query templates for the web API.
+
+Every template is compiled once when this module is imported, so handling
+a request only needs to render the already compiled template with the
+request parameters.
+'''
+import json
+
+from jinja2 import Template
+
+from geocoder.ngram import NGRAM_MAX, NGRAM_MIN, STOP_FIELDS
+
+
+class QueryTemplate(object):
+    '''A Jinja template compiled once and rendered for every request.'''
+    def __init__(self, source):
+        self.source = source
+        # _msearch header/body pairs must each end in a newline
+        self.template = Template(source, keep_trailing_newline=True)
+
+    def render(self, *args, **kwargs):
+        '''Render the query body with the given parameters.'''
+        return self.template.render(*args, **kwargs)
+
+
+def msearch(queries):
+    '''
+    Join rendered _msearch header/body pairs into one request body.
+
+    ES requires a blank line at the end (not documented).
+    '''
+    return ''.join(queries) + '\n'
+
+
+ADDRESS = QueryTemplate(
+    '{"type": "address"}\n'
+    '{"query": {'
+       '"filtered": {'
+         '"filter": {'
+           '"bool" : {'
+             '"must" : ['
+               '{"or": ['
+                 '{"term": {"kaupunki.lower": "{{ city.lower() }}"}},'
+                 '{"term": {"staden.lower": "{{ city.lower() }}"}}'
+               ']},'
+               '{"or": ['
+                 '{"term": {"katunimi.lower": "{{ streetname.lower() }}"}},'
+                 '{"term": {"gatan.lower": "{{ streetname.lower() }}"}}'
+               ']},'
+               '{% if divisor %}'
+               '{"term": {"osoitenumero": "{{ number }}"}},'
+               '{"term": {"kiinteiston_jakokirjain": "{{ divisor }}"}}'
+               '{% else %}'
+               '{"range": {'
+                 '"osoitenumero": {"lte": {{ streetnumber }} }}},'
+               '{"range": {'
+                 '"osoitenumero2": {"gte" : {{ streetnumber }} }}},'
+                 '{"term": {"left_side": "{{ left_side }}" }}'
+               '{% endif %}'
+    ']}}}}}\n'
+    '{"type": "osm_address"}\n'
+    '{"query": {'
+       '"filtered": {'
+         '"filter": {'
+           '"bool" : {'
+             '"must" : ['
+               '{"term": { "municipality": "{{ city.lower() }}"}},'
+               # XXX Title case doesn't work for "Ida Aalbergin tie"
+               '{"term": { "street": "{{ streetname.title() }}"}},'
+               '{"term": { "number": "{{ streetnumber }}" }}'
+    ']}}}}}\n')
+
+STREET = QueryTemplate(
+    '{"type": "address"}\n'
+    '{"size": 10,'
+     '"query": {'
+       '"filtered": {'
+         '"filter": {'
+           '"bool" : {'
+             '"must" : ['
+               '{"or": ['
+                 '{"term": {"kaupunki.lower": "{{ city.lower() }}"}},'
+                 '{"term": {"staden.lower": "{{ city.lower() }}"}}'
+               ']},'
+               '{"or": ['
+                 '{"term": {"katunimi.lower": "{{ streetname.lower() }}"}},'
+                 '{"term": {"gatan.lower": "{{ streetname.lower() }}"}}'
+               ']}'
+    ']}}}}}\n'
+    '{"type": "osm_address"}\n'
+    '{"size": 10,'
+     '"query": {'
+       '"filtered": {'
+         '"filter": {'
+           '"bool" : {'
+             '"must" : ['
+               '{"term": { "municipality": "{{ city.lower() }}"}},'
+               # XXX Title case doesn't work for "Ida Aalbergin tie"
+               '{"term": { "street": "{{ streetname.title() }}"}}'
+    ']}}}}}\n')
+
+# Find street names by matching correctly written part from middle.
+# Rendered once for Finnish and once for Swedish names.
+SUGGEST_STREETS = QueryTemplate(
+    '{"search_type" : "count", "type": "address"}\n'
+    '{"query": {'
+       '"filtered": {'
+        '"query": {'
+         # The space keeps Jinja from reading {{% as an expression
+         ' {% if ngram %}'
+          '"term": {'
+            '"{{ street_field }}.ngram": "{{ search_term.lower() }}"}'
+         '{% else %}'
+          '"wildcard": {'
+            '"{{ street_field }}.lower": "*{{ search_term.lower() }}*"}'
+         '{% endif %}'
+         '}'
+         '{% if cities or geo %}'
+         ',"filter": {"bool": {"must": ['
+           '{% if cities %}'
+           '{"or": ['
+           '{% for city in cities %}'
+             '{"term": {"kaupunki.lower": "{{ city.lower() }}"}},'
+             '{"term": {"staden.lower": "{{ city.lower() }}"}}'
+             '{% if not loop.last %},{% endif %}'
+           '{% endfor %}'
+           ']}'
+           '{% if geo %},{% endif %}'
+           '{% endif %}'
+           '{{ geo or "" }}'
+           ']}}'
+       '{% endif %}'
+     '}},'
+     '"aggs": {'
+       '"streets": {'
+         '"terms": { "field": "{{ street_field }}", "size": 10 },'
+         '"aggs": {'
+           '"cities": {'
+             '"terms": { "field": "{{ city_field }}", "size": 10 }}}}}}\n')
+
+# Find correctly written stops from one Digiroad field: names, descriptions
+# (often crossing street name, or closest address), stop codes or addresses
+SUGGEST_STOPS = QueryTemplate(
+    '{"type": "digiroad_stop"}\n'
+    '{"size": 10, "query": {'
+       '"filtered": {'
+        '"query": {'
+         # The space keeps Jinja from reading {{% as an expression
+         ' {% if ngram %}'
+          '"term": {'
+             '"{{ stop_field }}.ngram": "{{ search_term.lower() }}"}'
+         '{% else %}'
+          '"wildcard": {'
+             '"{{ stop_field }}": "*{{ search_term.lower() }}*"}'
+         '{% endif %}'
+         '}'
+         '{% if cities or geo %}'
+         ',"filter": {"bool": {"must": ['
+           '{% if cities %}'
+           '{"or": ['
+           '{% for city in cities %}'
+             '{"term": {"MUNICIPALITY_NAME": "{{ city.lower() }}"}}'
+             '{% if not loop.last %},{% endif %}'
+           '{% endfor %}'
+           ']}'
+           '{% if geo %},{% endif %}'
+           '{% endif %}'
+           '{{ geo or "" }}'
+           ']}}'
+       '{% endif %}'
+       '}}}\n')
+
+# Find incorrectly written street names with maximum Levenstein
+# distance of 2 (hardcoded into Elasticsearch)
+# XXX Would be nice if we could do a fuzzy wildcard search...
+# http://www.elastic.co/guide/en/elasticsearch/reference/master/search-suggesters-completion.html
+# allows at least fuzzy prefix suggestions
+SUGGEST_FUZZY = QueryTemplate(
+    '{"search_type" : "count", "type": "address"}\n'
+    '{"query": {'
+       # The space keeps Jinja from reading {{% as an expression
+       ' {% if geo %}'
+       '"filtered": {'
+        '"query": { '
+       '{% endif %}'
+       '"fuzzy": {'
+         '"katunimi.lower": "{{ search_term.lower() }}"}'
+       '{% if geo %}'
+        '},'
+        '"filter": {{ geo }}}'
+       '{% endif %}'
+     '},'
+     '"aggs": {'
+       '"streets": {"terms": {"field": "katunimi", "size": 10 }}}}\n')
+
+# Location filter of the suggest queries, either the bounding box
+# (min lon, min lat, max lon, max lat) or the circle around a focus point
+SUGGEST_GEO = QueryTemplate(
+    '{% if bbox %}'
+    '{"geo_bounding_box": {'
+      '"location": {'
+        '"top_left": {"lat": {{ bbox[3] }}, "lon": {{ bbox[0] }}},'
+        '"bottom_right": {"lat": {{ bbox[1] }}, "lon": {{ bbox[2] }}}}}}'
+    '{% else %}'
+    '{"geo_distance": {'
+      '"distance": "{{ radius }}km",'
+      '"location": {"lat": {{ lat }}, "lon": {{ lon }}}}}'
+    '{% endif %}')
+
+REVERSE_ADDRESS = QueryTemplate('''{
+     "sort" : [{"_geo_distance" : {
+                    "location": {
+                        "lat":  {{ lat }},
+                        "lon": {{ lon }}
+                    },
+                    "order" : "asc",
+                    "unit" : "km",
+                    "mode" : "min",
+                    "distance_type" : "plane"
+                    } }] }''')
+
+# Addresses have geo_points, but municipalities geo_shapes.
+# The shapes cannot be used in distance queries or sorting,
+# so we check whether a point shape intersects (ES default,
+# but here explicitly) with the municipality boundaries.
+REVERSE_CITY = QueryTemplate('''{
+"query": {
+    "filtered": {
+      "filter": {
+        "geo_shape": {
+          "boundaries": {
+            "relation": "intersects",
+            "shape": {
+              "coordinates": [
+                {{ lon }},
+                {{ lat }}
+              ],
+              "type": "point"
+            }
+          }
+        }
+      }
+    }
+}}''')
+
+INTERPOLATE = QueryTemplate('''{
+     "query": { "filtered": {
+         "filter": {
+             "bool" : {
+                 "must" : [
+                     {"term": {"nimi": "{{ streetname.lower() }}"}},
+                     {"range":
+                        {"min_{{ side }}": {"lte" : {{ streetnumber }} }}},
+                     {"range":
+                        {"max_{{ side }}": {"gte" : {{ streetnumber }} }}}]}
+
+  }}}}''')
+
+
+# Names of the _msearch subqueries, in the order of their responses
+ADDRESS_NAMES = ('hri', 'osm')
+SUGGEST_NAMES = (('streets_fi', 'streets_sv') +
+                 tuple('stops_' + field.lower() for field in STOP_FIELDS) +
+                 ('fuzzy',))
+# The street and city fields of the street subqueries, and the field of
+# the stop subqueries
+SUGGEST_FIELDS = dict([('streets_fi', ('katunimi', 'kaupunki')),
+                       ('streets_sv', ('gatan', 'staden'))] +
+                      list(zip(SUGGEST_NAMES[2:7], STOP_FIELDS)))
+# Sources that can be chosen with the sources argument of the suggest
+# endpoint, and their subqueries
+SUGGEST_SOURCES = {'streets': ('streets_fi', 'streets_sv'),
+                   'stops': tuple(name for name in SUGGEST_NAMES
+                                  if name.startswith('stops_')),
+                   'fuzzy': ('fuzzy',)}
+# In the tiered suggest mode, the second tier is only queried if the
+# first one finds too few suggestions. Exact name and stop code matches
+# come first, the description and address wildcards and the fuzzy
+# aggregation over all addresses later.
+SUGGEST_TIERS = (('streets_fi', 'streets_sv', 'stops_name_fi', 'stops_name_sv',
+                  'stops_stop_code'),
+                 ('stops_comments', 'stops_address', 'fuzzy'))
+
+
+def with_profile(body, multi):
+    '''
+    Rendered query body, or _msearch body if multi is true, with the
+    ES profile API enabled for every query.
+    '''
+    if not multi:
+        query = json.loads(body)
+        query['profile'] = True
+        return json.dumps(query)
+    lines = body.split('\n')
+    # Every other line is a query, the others are their headers
+    for i in range(1, len(lines), 2):
+        if lines[i]:
+            query = json.loads(lines[i])
+            query['profile'] = True
+            lines[i] = json.dumps(query)
+    return '\n'.join(lines)
+
+
+def suggest(search_term, cities, ngram=True, subqueries=SUGGEST_NAMES, geo=None):
+    '''
+    Render the _msearch body for the suggest endpoint, with the given
+    subqueries in the order of SUGGEST_NAMES. geo is a rendered SUGGEST_GEO
+    filter that every subquery must match, if given.
+
+    With ngram, search terms of n-gram length are looked up from the
+    .ngram subfields, others fall back to wildcard queries.
+    '''
+    ngram = ngram and NGRAM_MIN <= len(search_term) <= NGRAM_MAX
+    queries = []
+    # Only the chosen subqueries are rendered, as the deadline mode
+    # renders an _msearch for each of them
+    for name in SUGGEST_NAMES:
+        if name not in subqueries:
+            continue
+        if name == 'fuzzy':
+            queries.append(SUGGEST_FUZZY.render(search_term=search_term, geo=geo))
+        elif name.startswith('stops_'):
+            queries.append(SUGGEST_STOPS.render(
+                search_term=search_term, cities=cities, ngram=ngram, geo=geo,
+                stop_field=SUGGEST_FIELDS[name]))
+        else:
+            street_field, city_field = SUGGEST_FIELDS[name]
+            queries.append(SUGGEST_STREETS.render(
+                search_term=search_term, cities=cities, ngram=ngram, geo=geo,
+                street_field=street_field, city_field=city_field))
+    return msearch(queries)
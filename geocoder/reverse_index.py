@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+'''
+In-process spatial index of addresses for reverse geocoding.
+
+The address points are bucketed into a regular grid of cells sorted
+into NumPy arrays. Looking up the nearest address searches rings of
+cells around the query point outwards until no unsearched cell can
+contain a closer point.
+'''
+import logging
+from math import cos, floor, radians
+
+import numpy as np
+
+from geocoder import scroll
+
+# Grid cell size in degrees of latitude, about 500 m
+CELL_SIZE = 0.005
+# Rings of empty cells to search before comparing against every address
+MAX_RINGS = 20
+# Points whose distances to the candidate addresses are computed at once
+CHUNK_SIZE = 1000
+
+
+class NearestAddressIndex(object):
+    '''
+    Nearest neighbour index over address documents with a location.
+
+    Distances are computed in an equirectangular projection around the
+    mean latitude of the data, which is accurate enough at city scale
+    (Elasticsearch's "plane" distance is a similar approximation).
+    '''
+    def __init__(self, addresses, cell_size=CELL_SIZE):
+        addresses = list(addresses)
+        lonlat = np.array([a['location'] for a in addresses], dtype=np.float64)
+        if not len(lonlat):
+            lonlat = lonlat.reshape((0, 2))
+        self.cell_size = cell_size
+        self.scale = cos(radians(lonlat[:, 1].mean())) if len(lonlat) else 1.0
+        x = lonlat[:, 0] * self.scale
+        y = lonlat[:, 1]
+        ix = np.floor(x / cell_size).astype(np.int64)
+        iy = np.floor(y / cell_size).astype(np.int64)
+        order = np.lexsort((iy, ix))
+        self.addresses = [addresses[i] for i in order]
+        self.x = x[order]
+        self.y = y[order]
+        ix = ix[order]
+        iy = iy[order]
+
+        # Every non-empty cell maps to its slice of the sorted arrays
+        self.cells = {}
+        if len(order):
+            boundaries = np.flatnonzero((np.diff(ix) != 0) | (np.diff(iy) != 0)) + 1
+            starts = np.concatenate(([0], boundaries))
+            ends = np.concatenate((boundaries, [len(order)]))
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                self.cells[(int(ix[start]), int(iy[start]))] = (start, end)
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def _ring(self, cx, cy, r):
+        '''Slices of the non-empty cells at Chebyshev distance r from (cx, cy).'''
+        if r == 0:
+            cells = [(cx, cy)]
+        else:
+            cells = [(cx + dx, cy + dy) for dx in range(-r, r + 1) for dy in (-r, r)]
+            cells.extend((cx + dx, cy + dy) for dx in (-r, r) for dy in range(-r + 1, r))
+        return [self.cells[c] for c in cells if c in self.cells]
+
+    def nearest_index(self, lat, lon):
+        '''Position of the nearest address in self.addresses, or None if empty.'''
+        if not self.addresses:
+            return None
+        qx = lon * self.scale
+        cx = int(floor(qx / self.cell_size))
+        cy = int(floor(lat / self.cell_size))
+        best = None
+        best_distance = float('inf')
+        for r in range(MAX_RINGS + 1):
+            for start, end in self._ring(cx, cy, r):
+                distances = ((self.x[start:end] - qx) ** 2 +
+                             (self.y[start:end] - lat) ** 2)
+                i = int(distances.argmin())
+                if distances[i] < best_distance:
+                    best_distance = distances[i]
+                    best = start + i
+            # Points outside the searched rings are at least r cells away
+            if best is not None and best_distance <= (r * self.cell_size) ** 2:
+                return best
+        # Far away from all addresses, so just compare against every one
+        return int(((self.x - qx) ** 2 + (self.y - lat) ** 2).argmin())
+
+    def nearest_indexes(self, lats, lons):
+        '''
+        Positions of the nearest addresses for arrays of points,
+        or -1 for every point if there are no addresses.
+
+        Points in the same grid cell are searched together, computing
+        the distances from up to CHUNK_SIZE of them to all the candidate
+        addresses around the cell at once.
+        '''
+        qx = np.asarray(lons, dtype=np.float64) * self.scale
+        qy = np.asarray(lats, dtype=np.float64)
+        result = np.full(len(qx), -1, dtype=np.int64)
+        if not self.addresses or not len(qx):
+            return result
+        cx = np.floor(qx / self.cell_size).astype(np.int64)
+        cy = np.floor(qy / self.cell_size).astype(np.int64)
+        groups = {}
+        for i, cell in enumerate(zip(cx.tolist(), cy.tolist())):
+            groups.setdefault(cell, []).append(i)
+
+        chunks = ((cell, members[start:start + CHUNK_SIZE])
+                  for cell, members in groups.items()
+                  for start in range(0, len(members), CHUNK_SIZE))
+        for (gx, gy), members in chunks:
+            pending = np.array(members)
+            candidates = np.empty(0, dtype=np.int64)
+            for r in range(MAX_RINGS + 1):
+                ring = self._ring(gx, gy, r)
+                if ring:
+                    candidates = np.concatenate(
+                        [candidates] + [np.arange(start, end) for start, end in ring])
+                if not len(candidates):
+                    continue
+                distances = ((self.x[candidates][None, :] - qx[pending][:, None]) ** 2 +
+                             (self.y[candidates][None, :] - qy[pending][:, None]) ** 2)
+                best = distances.argmin(axis=1)
+                # Points outside the searched rings are at least r cells away
+                done = (distances[np.arange(len(pending)), best] <=
+                        (r * self.cell_size) ** 2)
+                result[pending[done]] = candidates[best[done]]
+                pending = pending[~done]
+                if not len(pending):
+                    break
+            # Far away from all addresses, so just compare against every one
+            for i in pending:
+                result[i] = ((self.x - qx[i]) ** 2 + (self.y - qy[i]) ** 2).argmin()
+        return result
+
+    def nearest(self, lat, lon):
+        '''The nearest address document, or None if there are no addresses.'''
+        i = self.nearest_index(lat, lon)
+        return None if i is None else self.addresses[i]
+
+
+def load(es_url):
+    '''Build a NearestAddressIndex from the address doctype in Elasticsearch.'''
+    index = NearestAddressIndex(scroll.documents(es_url, 'address'))
+    logging.info("Indexed %i addresses for reverse geocoding", len(index))
+    return index
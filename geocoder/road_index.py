@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+'''
+In-process index of National Land Survey road segments for interpolating
+address locations.
+
+Segments are grouped by lowercased street name, and for both sides of
+the street their address number ranges are kept in arrays sorted by the
+range start, so the segment containing a number is found with a binary
+search. Each segment stores the cumulative lengths along its line, so
+interpolation is a second binary search and linear arithmetic.
+'''
+from bisect import bisect_left, bisect_right
+import logging
+from math import hypot
+
+from geocoder import scroll
+
+SIDES = ('vasen', 'oikea')
+
+
+def _number(value):
+    '''Range numbers may come from ES as single item lists.'''
+    if isinstance(value, list):
+        value = value[0]
+    return int(value)
+
+
+class Segment(object):
+    '''A road segment line with precomputed cumulative lengths.'''
+    def __init__(self, coordinates):
+        self.coordinates = [tuple(c[:2]) for c in coordinates]
+        self.lengths = [0.0]
+        for (x0, y0), (x1, y1) in zip(self.coordinates, self.coordinates[1:]):
+            self.lengths.append(self.lengths[-1] + hypot(x1 - x0, y1 - y0))
+
+    def interpolate(self, fraction):
+        '''
+        Point at the given fraction of the length of the line, measured
+        like Shapely's normalized LineString.interpolate.
+        '''
+        distance = min(max(fraction, 0.0), 1.0) * self.lengths[-1]
+        i = bisect_left(self.lengths, distance)
+        if i == 0:
+            return list(self.coordinates[0])
+        (x0, y0), (x1, y1) = self.coordinates[i - 1], self.coordinates[i]
+        part = self.lengths[i] - self.lengths[i - 1]
+        t = (distance - self.lengths[i - 1]) / part if part else 0.0
+        return [x0 + t * (x1 - x0), y0 + t * (y1 - y0)]
+
+
+class SideRanges(object):
+    '''Address number ranges on one side of a street, sorted by range start.'''
+    def __init__(self):
+        self.ranges = []
+        self.mins = []
+        self.maxs = []
+        # Largest range end among this and all earlier ranges
+        self.max_so_far = []
+        self.segments = []
+
+    def add(self, minimum, maximum, segment):
+        self.ranges.append((minimum, maximum, segment))
+
+    def finalize(self):
+        self.ranges.sort(key=lambda r: r[:2])
+        self.mins = [r[0] for r in self.ranges]
+        self.maxs = [r[1] for r in self.ranges]
+        self.segments = [r[2] for r in self.ranges]
+        self.max_so_far = []
+        for maximum in self.maxs:
+            self.max_so_far.append(max(maximum, self.max_so_far[-1])
+                                   if self.max_so_far else maximum)
+        del self.ranges
+
+    def find(self, number):
+        '''(min, max, segment) of a range containing number, or None.'''
+        i = bisect_right(self.mins, number) - 1
+        while i >= 0 and self.max_so_far[i] >= number:
+            if self.maxs[i] >= number:
+                return self.mins[i], self.maxs[i], self.segments[i]
+            i -= 1
+        return None
+
+
+class RoadIndex(object):
+    '''Road segments by lowercased Finnish street name and side.'''
+    def __init__(self):
+        self.streets = {}
+
+    def __len__(self):
+        return len(self.streets)
+
+    def add(self, document):
+        '''Add an interpolated_address document. Address points are skipped.'''
+        if document.get('location', {}).get('type') != 'LineString':
+            return
+        segment = None
+        for side in SIDES:
+            if 'min_' + side not in document:
+                continue
+            if segment is None:
+                segment = Segment(document['location']['coordinates'])
+            sides = self.streets.setdefault(document['nimi'].lower(),
+                                            {s: SideRanges() for s in SIDES})
+            sides[side].add(_number(document['min_' + side]),
+                            _number(document['max_' + side]), segment)
+
+    def finalize(self):
+        '''Sort the ranges after all segments have been added.'''
+        for sides in self.streets.values():
+            for ranges in sides.values():
+                ranges.finalize()
+
+    def interpolate(self, streetname, streetnumber):
+        '''
+        Interpolated [lon, lat] of the address, or None if no segment
+        on the right side of the street has the number in its range.
+        '''
+        sides = self.streets.get(streetname.lower())
+        if sides is None:
+            return None
+        side = 'vasen' if streetnumber % 2 == 0 else 'oikea'
+        found = sides[side].find(streetnumber)
+        if found is None:
+            return None
+        minimum, maximum, segment = found
+        if maximum == minimum:
+            fraction = 0.5
+        else:
+            fraction = (streetnumber - minimum) / (maximum - minimum)
+        return segment.interpolate(fraction)
+
+
+def load(es_url):
+    '''Build a RoadIndex from the interpolated_address doctype in Elasticsearch.'''
+    index = RoadIndex()
+    for document in scroll.documents(es_url, 'interpolated_address'):
+        index.add(document)
+    index.finalize()
+    logging.info("Indexed road segments of %i streets", len(index))
+    return index
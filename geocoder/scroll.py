@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+'''Read whole doctypes from Elasticsearch for the in-process indexes.'''
+import json
+import logging
+from urllib.parse import urljoin
+
+from tornado.httpclient import HTTPClient
+
+# Documents per shard in each scroll page
+PAGE_SIZE = 1000
+
+
+def hits(es_url, doctype, timeout='5m'):
+    '''
+    Generator of all hits of a doctype, with their _id and _source,
+    read with a scan/scroll search.
+
+    es_url is the index URL, for example http://localhost:9200/reittiopas/
+    '''
+    client = HTTPClient()
+    try:
+        response = client.fetch(
+            '%s%s/_search?search_type=scan&scroll=%s&size=%i' % (
+                es_url, doctype, timeout, PAGE_SIZE),
+            method='POST', body='{"query": {"match_all": {}}}',
+            request_timeout=600)
+        scroll_id = json.loads(response.body.decode('utf-8'))['_scroll_id']
+        count = 0
+        while True:
+            response = client.fetch(
+                urljoin(es_url, '/_search/scroll?scroll=' + timeout),
+                method='POST', body=scroll_id, request_timeout=600)
+            data = json.loads(response.body.decode('utf-8'))
+            if not data['hits']['hits']:
+                break
+            scroll_id = data['_scroll_id']
+            yield from data['hits']['hits']
+            count += len(data['hits']['hits'])
+        logging.info("Read %i %s documents from ElasticSearch", count, doctype)
+    finally:
+        client.close()
+
+
+def documents(es_url, doctype, timeout='5m'):
+    '''Generator of the _source dicts of all documents of a doctype.'''
+    for hit in hits(es_url, doctype, timeout):
+        yield hit['_source']
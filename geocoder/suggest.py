@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+'''
+Search-as-you-type helpers for the suggest endpoint.
+
+Users type a street or stop name one character at a time, so the search
+term of a request usually extends the term of an earlier request. Every
+infix sub-query of the suggest _msearch matches a subset of what the same
+sub-query matched for any part of the term. When all the earlier results
+were complete, i.e. not truncated by the size limits of the queries, the
+results for the longer term can be computed by filtering them locally.
+'''
+import re
+
+from geocoder.cache import ResponseCache
+from geocoder.ngram import STOP_FIELDS
+
+# The size limit used in the suggest queries
+SIZE = 10
+
+# Stop names are analyzed into words, so narrowing is only exact
+# for terms that fit inside one word.
+_NARROWABLE = re.compile(r'^\w+$')
+
+
+def is_complete(response):
+    '''Whether a sub-response contains every match instead of the first SIZE.'''
+    if 'aggregations' in response:
+        streets = response['aggregations']['streets']
+        return (len(streets['buckets']) < SIZE and
+                not streets.get('sum_other_doc_count'))
+    hits = response['hits']
+    return hits['total'] <= len(hits['hits'])
+
+
+def section(name):
+    '''The suggest response section with the results of a sub-query.'''
+    if name.startswith('stops_'):
+        return 'stops'
+    return {'streets_fi': 'streetnames_fi', 'streets_sv': 'streetnames_sv',
+            'fuzzy': 'fuzzy_streetnames'}[name]
+
+
+def empty_response(name):
+    '''A sub-response without matches, for a sub-query that was not sent.'''
+    if name.startswith('stops_'):
+        return {'hits': {'total': 0, 'hits': []}}
+    return {'aggregations': {'streets': {'buckets': []}}}
+
+
+def suggestion_count(responses):
+    '''
+    Number of Finnish street names and distinct stops in the sub-responses,
+    keyed by sub-query name.
+    '''
+    stops = set()
+    for name, response in responses.items():
+        if name.startswith('stops_'):
+            stops.update(hit['_id'] for hit in response['hits']['hits'])
+    streets = responses.get('streets_fi')
+    return len(stops) + (len(streets['aggregations']['streets']['buckets'])
+                         if streets else 0)
+
+
+def narrow(responses, search_term):
+    '''
+    Filter the street and stop sub-responses of a shorter search term
+    down to those matching search_term.
+    '''
+    term = search_term.lower()
+    narrowed = []
+    for response in responses[:2]:
+        buckets = [b for b in response['aggregations']['streets']['buckets']
+                   if term in b['key'].lower()]
+        narrowed.append({'aggregations': {'streets': {'buckets': buckets}}})
+    for field, response in zip(STOP_FIELDS, responses[2:]):
+        hits = [h for h in response['hits']['hits']
+                if term in (h['_source'].get(field) or '').lower()]
+        narrowed.append({'hits': {'total': len(hits), 'hits': hits}})
+    return narrowed
+
+
+class PrefixCandidates(ResponseCache):
+    '''
+    Cache of complete street and stop sub-responses of earlier search terms,
+    keyed on the lowercased term and the city filter.
+    '''
+    def add(self, search_term, cities, responses):
+        '''Remember the infix sub-responses if none of them was truncated.'''
+        if all(is_complete(r) for r in responses):
+            self.put((search_term.lower(), cities), responses)
+
+    def find(self, search_term, cities):
+        '''
+        Return sub-responses for search_term narrowed from the longest
+        cached prefix, or None if the term must be sent to ES.
+        '''
+        term = search_term.lower()
+        if not _NARROWABLE.match(term):
+            return None
+        for end in range(len(term) - 1, 0, -1):
+            responses = self.get((term[:end], cities))
+            if responses is not None:
+                responses = narrow(responses, term)
+                self.put((term, cities), responses)
+                return responses
+        return None
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+'''
+In-process substring index of street and stop names for the suggest
+endpoint.
+
+The distinct Finnish and Swedish street names and the values of the
+searched Digiroad stop fields are few enough to keep in memory. Each
+set of values is kept in a suffix array, so the values containing the
+search term are found with two binary searches instead of an infix
+query in Elasticsearch.
+
+Typo fixes are found in a SymSpell style deletion dictionary of the
+lowercased street names: every string made by deleting up to two
+characters from the beginning of a name points to the name, so the names
+close to a misspelled term are found by looking up the deletions of the
+term, and only those are compared to it.
+
+The results are built in the shape of the sub-responses of the suggest
+_msearch.
+'''
+from array import array
+from collections import Counter
+import logging
+
+from geocoder import scroll
+from geocoder.ngram import STOP_FIELDS
+from geocoder.suggest import SIZE
+
+# Separates the values in the suffix array text. Sorts before every
+# other character, so it works as the end of each suffix.
+_END = '\0'
+# Like the ES fuzzy query with the default fuzziness, terms of up to 2
+# characters must match exactly, up to 5 characters with 1 edit and
+# longer terms with 2 edits.
+MAX_DISTANCE = 2
+# Only the deletions of this many first characters of the names are
+# indexed, which keeps the dictionary small. Each edit shifts the rest
+# of the term by at most one character, so the deletions of the term
+# prefixes of this length plus or minus the allowed edits are looked up.
+PREFIX_LENGTH = 7
+
+
+class SubstringIndex(object):
+    '''Suffix array finding which of a list of strings contain a substring.'''
+    def __init__(self, strings):
+        self.text = _END.join(strings) + _END
+        self.size = len(strings)
+        positions = []
+        owners = []
+        offset = 0
+        for i, string in enumerate(strings):
+            positions.extend(range(offset, offset + len(string)))
+            owners.extend([i] * len(string))
+            offset += len(string) + 1
+        text = self.text
+        order = sorted(range(len(positions)),
+                       key=lambda n: text[positions[n]:text.index(_END, positions[n])])
+        self.positions = array('i', (positions[n] for n in order))
+        self.owners = array('i', (owners[n] for n in order))
+
+    def _bisect(self, term, right):
+        '''First suffix starting with more than term, or with at least term.'''
+        text, length = self.text, len(term)
+        lo, hi = 0, len(self.positions)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            prefix = text[self.positions[mid]:self.positions[mid] + length]
+            if prefix < term or (right and prefix == term):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, term):
+        '''Sorted indexes of the strings containing term.'''
+        if not term:
+            return list(range(self.size))
+        if _END in term:
+            return []
+        start = self._bisect(term, False)
+        end = self._bisect(term, True)
+        return sorted(set(self.owners[start:end]))
+
+
+def max_distance(term):
+    '''Number of edits allowed for a term of this length.'''
+    if len(term) <= 2:
+        return 0
+    if len(term) <= 5:
+        return min(1, MAX_DISTANCE)
+    return MAX_DISTANCE
+
+
+def deletions(word, distance):
+    '''word and all the strings made by deleting up to distance characters from it.'''
+    found = {word}
+    edge = {word}
+    for _ in range(distance):
+        edge = {w[:i] + w[i + 1:] for w in edge for i in range(len(w))}
+        found |= edge
+    return found
+
+
+def edit_distance(a, b):
+    '''Levenshtein distance between two strings.'''
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+def _top(counts):
+    '''The SIZE largest counts as terms aggregation buckets, and the rest summed.'''
+    ordered = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+    return ([{'key': key, 'doc_count': count} for key, count in ordered[:SIZE]],
+            sum(count for _, count in ordered[SIZE:]))
+
+
+class StreetNames(object):
+    '''
+    Distinct street names in one language, with the number of addresses
+    in each city.
+    '''
+    def __init__(self, street_field, city_field):
+        self.street_field = street_field
+        self.city_field = city_field
+        # Street name -> (city, lowercased kaupunki, lowercased staden) -> count
+        self.counts = {}
+        self.names = []
+        self.index = None
+
+    def add(self, address):
+        name = address[self.street_field]
+        if not name:
+            return
+        key = (address[self.city_field], address['kaupunki'].lower(),
+               address['staden'].lower())
+        cities = self.counts.setdefault(name, Counter())
+        cities[key] += 1
+
+    def finalize(self):
+        self.names = sorted(self.counts)
+        self.index = SubstringIndex([name.lower() for name in self.names])
+
+    def response(self, term, cities):
+        '''
+        Streets containing term, aggregated like the street sub-response:
+        the SIZE streets with most addresses, and in each of them the SIZE
+        cities with most addresses. cities are lowercased Finnish or
+        Swedish city names to filter with.
+        '''
+        streets = {}
+        for i in self.index.find(term):
+            name = self.names[i]
+            counts = Counter()
+            for (city, kaupunki, staden), count in self.counts[name].items():
+                if not cities or kaupunki in cities or staden in cities:
+                    counts[city] += count
+            if counts:
+                streets[name] = counts
+        buckets, other = _top({name: sum(counts.values())
+                               for name, counts in streets.items()})
+        for bucket in buckets:
+            city_buckets, city_other = _top(streets[bucket['key']])
+            bucket['cities'] = {'buckets': city_buckets,
+                                'sum_other_doc_count': city_other}
+        return {'aggregations': {'streets': {'buckets': buckets,
+                                             'sum_other_doc_count': other}}}
+
+
+class StopField(object):
+    '''Distinct values of one Digiroad field, and the stops having them.'''
+    def __init__(self, field):
+        self.field = field
+        self.stops = {}
+        self.values = []
+        self.index = None
+
+    def add(self, hit):
+        value = hit['_source'].get(self.field)
+        if value is None or value == '':
+            return
+        self.stops.setdefault(str(value).lower(), []).append(hit)
+
+    def finalize(self):
+        # Shortest values first, as they match the term most closely
+        self.values = sorted(self.stops, key=lambda value: (len(value), value))
+        self.index = SubstringIndex(self.values)
+
+    def response(self, term, cities):
+        '''
+        Stops whose value contains term, as hits like the stop sub-response.
+        cities are lowercased municipality names to filter with.
+        '''
+        hits = []
+        for i in self.index.find(term):
+            for hit in self.stops[self.values[i]]:
+                if (not cities or
+                        (hit['_source'].get('MUNICIPALITY_NAME') or '').lower() in cities):
+                    hits.append(hit)
+        return {'hits': {'total': len(hits), 'hits': hits[:SIZE]}}
+
+
+class TypoIndex(object):
+    '''Deletion dictionary of Finnish and Swedish street names.'''
+    def __init__(self):
+        # Street name -> number of addresses
+        self.counts = Counter()
+        self.names = []
+        self.lowered = []
+        # Deletion -> indexes of the names it was made from
+        self.deletions = {}
+
+    def add(self, address):
+        for name in {address['katunimi'], address['gatan']}:
+            if name:
+                self.counts[name] += 1
+
+    def finalize(self):
+        self.names = sorted(self.counts)
+        self.lowered = [name.lower() for name in self.names]
+        self.deletions = {}
+        for i, name in enumerate(self.lowered):
+            for deletion in deletions(name[:PREFIX_LENGTH], MAX_DISTANCE):
+                self.deletions.setdefault(deletion, []).append(i)
+
+    def find(self, term):
+        '''Indexes of the names within the allowed edit distance of term.'''
+        distance = max_distance(term)
+        candidates = set()
+        prefixes = {term[:length] for length in range(PREFIX_LENGTH - distance,
+                                                      PREFIX_LENGTH + distance + 1)}
+        for prefix in prefixes:
+            for deletion in deletions(prefix, distance):
+                candidates.update(self.deletions.get(deletion, ()))
+        return sorted(i for i in candidates
+                      if abs(len(self.lowered[i]) - len(term)) <= distance and
+                      edit_distance(self.lowered[i], term) <= distance)
+
+    def response(self, term):
+        '''
+        The SIZE streets with most addresses close to term, like the
+        fuzzy sub-response.
+        '''
+        buckets, other = _top({self.names[i]: self.counts[self.names[i]]
+                               for i in self.find(term)})
+        return {'aggregations': {'streets': {'buckets': buckets,
+                                             'sum_other_doc_count': other}}}
+
+
+class SuggestIndex(object):
+    '''Street names from the address doctype and stops from digiroad_stop.'''
+    def __init__(self):
+        self.streets = [StreetNames('katunimi', 'kaupunki'),
+                        StreetNames('gatan', 'staden')]
+        self.stops = [StopField(field) for field in STOP_FIELDS]
+        self.typos = TypoIndex()
+
+    def add(self, address):
+        '''Add an address document from the address doctype.'''
+        for streets in self.streets:
+            streets.add(address)
+        self.typos.add(address)
+
+    def add_stop(self, hit):
+        '''Add a digiroad_stop hit, with its _id and _source.'''
+        for stops in self.stops:
+            stops.add(hit)
+
+    def finalize(self):
+        '''Build the indexes after all documents have been added.'''
+        for part in self.streets + self.stops + [self.typos]:
+            part.finalize()
+
+    def suggest(self, search_term, cities=()):
+        '''
+        The Finnish and Swedish street, the stop and the typo fix
+        sub-responses for search_term, in the order of queries.SUGGEST_NAMES.
+        Like the fuzzy query, typo fixes are not limited to the cities.
+        '''
+        term = search_term.lower()
+        cities = {city.lower() for city in cities}
+        return ([part.response(term, cities) for part in self.streets + self.stops] +
+                [self.typos.response(term)])
+
+
+def load(es_url):
+    '''Build a SuggestIndex from the address and digiroad_stop doctypes.'''
+    index = SuggestIndex()
+    for address in scroll.documents(es_url, 'address'):
+        index.add(address)
+    for hit in scroll.hits(es_url, 'digiroad_stop'):
+        index.add_stop(hit)
+    index.finalize()
+    logging.info("Indexed %i Finnish and %i Swedish street names for suggestions, "
+                 "with %i deletions for typo fixes", len(index.streets[0].names),
+                 len(index.streets[1].names), len(index.typos.deletions))
+    return index
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Micro-benchmarks for the hot paths of the web API.'''
+import json
+import random
+from time import perf_counter
+from timeit import timeit
+
+import click
+from jinja2 import Template
+from tornado.httpclient import HTTPClient
+
+from geocoder import queries, reverse_index
+
+
+def compile_template(query):
+    '''Compile the template of the query from source like every request used to.'''
+    return Template(query.source, keep_trailing_newline=True)
+
+
+def report(name, before, after, number):
+    '''Print per call timings in microseconds of the old and new code paths.'''
+    print('%-12s %10.1f µs %10.1f µs %8.1fx' % (
+        name, before / number * 1e6, after / number * 1e6, before / after))
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command('queries')
+@click.option("-n", '--number', default=2000, show_default=True,
+              help="Iterations per query")
+def bench_queries(number):
+    '''
+    Compare compiling the query template for every request (the old way)
+    to rendering templates compiled once at startup.
+    '''
+    cities = ['Espoo', 'Vantaa']
+    address = {'city': 'Helsinki', 'streetname': 'Mannerheimintie',
+               'streetnumber': '13', 'number': '13', 'divisor': '',
+               'left_side': 'false'}
+    reverse = {'lat': '60.17586', 'lon': '24.93369'}
+    print('%-12s %13s %13s %9s' % ('query', 'compile', 'precompiled', 'speedup'))
+
+    def suggest_uncompiled():
+        return queries.msearch(
+            [compile_template(queries.SUGGEST_STREETS).render(
+                search_term='mannerh', cities=cities,
+                street_field='katunimi', city_field='kaupunki'),
+             compile_template(queries.SUGGEST_STREETS).render(
+                 search_term='mannerh', cities=cities,
+                 street_field='gatan', city_field='staden')] +
+            [compile_template(queries.SUGGEST_STOPS).render(
+                search_term='mannerh', cities=cities, stop_field=field)
+             for field in queries.STOP_FIELDS] +
+            [compile_template(queries.SUGGEST_FUZZY).render(search_term='mannerh')])
+
+    report('suggest',
+           timeit(suggest_uncompiled, number=number),
+           timeit(lambda: queries.suggest('mannerh', cities, ngram=False), number=number),
+           number)
+    for name, template, kwargs in [('address', queries.ADDRESS, address),
+                                   ('street', queries.STREET, address),
+                                   ('reverse', queries.REVERSE_ADDRESS, reverse),
+                                   ('city', queries.REVERSE_CITY, reverse)]:
+        report(name,
+               timeit(lambda: compile_template(template).render(kwargs), number=number),
+               timeit(lambda: template.render(kwargs), number=number),
+               number)
+
+
+@main.command('reverse')
+@click.option('--es-url', default='http://localhost:9200/reittiopas/', show_default=True)
+@click.option("-n", '--number', default=200, show_default=True,
+              help="Number of random points in the capital area")
+def bench_reverse(es_url, number):
+    '''
+    Compare the nearest address query in ElasticSearch
+    to the in-memory nearest address index.
+    '''
+    start = perf_counter()
+    index = reverse_index.load(es_url)
+    print('Loaded %i addresses in %.1f s' % (len(index), perf_counter() - start))
+    # Same area as the MovingUser load test
+    points = [{'lat': random.uniform(60.16, 60.22), 'lon': random.uniform(24.65, 24.8)}
+              for _ in range(number)]
+    client = HTTPClient()
+
+    def es_nearest():
+        for point in points:
+            client.fetch(es_url + 'address/_search?size=1', method='POST',
+                         body=queries.REVERSE_ADDRESS.render(point))
+
+    def index_nearest():
+        for point in points:
+            index.nearest(point['lat'], point['lon'])
+
+    print('%-12s %13s %13s %9s' % ('query', 'ES', 'in-memory', 'speedup'))
+    report('reverse', timeit(es_nearest, number=1), timeit(index_nearest, number=1),
+           number)
+
+
+@main.command('suggest')
+@click.option('--es-url', default='http://localhost:9200/reittiopas/', show_default=True)
+@click.option("-n", '--number', default=20, show_default=True,
+              help="Repetitions of every search term")
+def bench_suggest(es_url, number):
+    '''
+    Compare the wildcard suggest queries to the n-gram subfield queries
+    in ElasticSearch, over the prefixes typed by the TypingUser load test.
+    Needs an index imported with the n-gram subfields.
+    '''
+    client = HTTPClient()
+    # Same search terms as the TypingUser load test
+    terms = ["Mannerheimintie"[0:i] for i in range(1, 15)]
+
+    def took(body):
+        '''Sum of the ES reported times of the subqueries in ms.'''
+        response = client.fetch(es_url + '_msearch', method='POST', body=body)
+        return sum(r['took'] for r in json.loads(response.body.decode('utf-8'))['responses'])
+
+    print('%-16s %13s %13s %9s' % ('term', 'wildcard', 'n-gram', 'speedup'))
+    total_wildcard = total_ngram = 0
+    for term in terms:
+        wildcard = queries.suggest(term, [], ngram=False)
+        ngram = queries.suggest(term, [], ngram=True)
+        # Warm up the caches of both
+        took(wildcard)
+        took(ngram)
+        wildcard_ms = sum(took(wildcard) for _ in range(number)) / number
+        ngram_ms = sum(took(ngram) for _ in range(number)) / number
+        total_wildcard += wildcard_ms
+        total_ngram += ngram_ms
+        print('%-16s %10.1f ms %10.1f ms %8.1fx' % (
+            term, wildcard_ms, ngram_ms, wildcard_ms / max(ngram_ms, 0.1)))
+    print('%-16s %10.1f ms %10.1f ms %8.1fx' % (
+        'mean', total_wildcard / len(terms), total_ngram / len(terms),
+        total_wildcard / max(total_ngram, 0.1)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import pytest
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from geocoder.admission import AdmissionControl, Overloaded
+from geocoder.es_client import Cancelled
+
+
+def run(coroutine):
+    loop = IOLoop()
+    try:
+        return loop.run_sync(coroutine)
+    finally:
+        loop.close()
+
+
+def test_priority_and_limits():
+    control = AdmissionControl(total=2, timeout=1)
+    control.configure(total=2, timeout=1, limits=[('suggest', 1, 1)])
+    admitted = []
+
+    @gen.coroutine
+    def request(name):
+        yield control.acquire(name)
+        admitted.append(name)
+
+    @gen.coroutine
+    def scenario():
+        yield control.acquire('suggest')
+        # The suggest limit is full, its queue holds one more
+        waiting_suggest = request('suggest')
+        # Let it reach the queue
+        yield gen.moment
+        with pytest.raises(Overloaded):
+            yield control.acquire('suggest')
+        yield control.acquire('reverse')
+        waiting = [request('reverse'), request('address')]
+        yield gen.moment
+        assert control.stats()['reverse']['waiting'] == 1
+        # Address has the highest priority, the suggest limit is still full
+        control.release('reverse')
+        yield gen.sleep(0.001)
+        assert admitted == ['address']
+        control.release('suggest')
+        control.release('address')
+        yield [waiting_suggest] + waiting
+        assert admitted == ['address', 'reverse', 'suggest']
+    run(scenario)
+
+
+def test_timeout():
+    control = AdmissionControl(total=1, timeout=0.01)
+
+    @gen.coroutine
+    def scenario():
+        yield control.acquire('address')
+        with pytest.raises(Overloaded):
+            yield control.acquire('reverse')
+        control.release('address')
+        assert control.stats()['reverse']['timeouts'] == 1
+        yield control.acquire('reverse')
+    run(scenario)
+
+
+def test_cancelled_while_waiting():
+    control = AdmissionControl(total=1, timeout=1)
+
+    @gen.coroutine
+    def scenario():
+        cancelled = Future()
+        yield control.acquire('address')
+        waiting = gen.convert_yielded(control.acquire('reverse', cancelled))
+        yield gen.moment
+        assert control.stats()['reverse']['waiting'] == 1
+        cancelled.set_result(None)
+        with pytest.raises(Cancelled):
+            yield waiting
+        stats = control.stats()['reverse']
+        assert (stats['waiting'], stats['cancelled'], stats['timeouts']) == (0, 1, 0)
+        control.release('address')
+        assert control.active == 0
+    run(scenario)
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+
+import pytest
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+from tornado.web import Application, RequestHandler
+
+from geocoder import app, queries
+from geocoder.cache import ResponseCache, SingleFlight
+from geocoder.es_client import ESClient
+from geocoder.suggest import PrefixCandidates
+
+
+def answer(query):
+    '''
+    Sub-response to a suggest query. The streets found with a location
+    filter are named differently from those found without one.
+    '''
+    text = json.dumps(query)
+    response = {'took': 1}
+    if query.get('profile'):
+        response['profile'] = {'shards': []}
+    if 'fuzzy' in text:
+        response['aggregations'] = {'streets': {'buckets': [
+            {'key': 'Mannerheimintie', 'doc_count': 1}]}}
+    elif 'aggs' in query:
+        name = 'Mannergeo' if 'geo_bounding_box' in text else 'Mannerheimintie'
+        response['aggregations'] = {'streets': {'buckets': [
+            {'key': name, 'doc_count': 1, 'cities': {'buckets': []}}]}}
+    else:
+        response['hits'] = {'total': 0, 'hits': []}
+    return response
+
+
+class FakeES(RequestHandler):
+    '''Answers _msearch queries after the delay, or the fuzzy delay.'''
+    def initialize(self, es):
+        self.es = es
+
+    @gen.coroutine
+    def post(self, path):
+        lines = self.request.body.decode('utf-8').split('\n')
+        found = [json.loads(line) for line in lines[1::2] if line]
+        self.es['queries'].extend(found)
+        if any('fuzzy' in json.dumps(query) for query in found):
+            yield gen.sleep(self.es['fuzzy_delay'])
+        else:
+            yield gen.sleep(self.es['delay'])
+        self.write({'responses': [answer(query) for query in found]})
+
+    # The queries are sent as GET requests with a body
+    get = post
+
+
+@pytest.fixture
+def io_loop():
+    loop = IOLoop()
+    loop.make_current()
+    yield loop
+    loop.clear_current()
+    loop.close(all_fds=True)
+
+
+def serve(application):
+    sock, port = bind_unused_port()
+    server = HTTPServer(application)
+    server.add_sockets([sock])
+    return 'http://127.0.0.1:%i/' % port
+
+
+@pytest.fixture
+def api(io_loop, monkeypatch):
+    '''The fake ES, and the URL of the web API using it.'''
+    es = {'queries': [], 'delay': 0, 'fuzzy_delay': 0}
+    es_url = serve(Application([(r"/reittiopas/(.*)", FakeES, {'es': es})]))
+    monkeypatch.setattr("geocoder.app.ES", ESClient([es_url + 'reittiopas/']))
+    monkeypatch.setattr("geocoder.app.SUGGEST_CACHE", ResponseCache())
+    monkeypatch.setattr("geocoder.app.SUGGEST_CANDIDATES", PrefixCandidates())
+    monkeypatch.setattr("geocoder.app.ES_QUERIES", SingleFlight())
+    return es, serve(app.make_app())
+
+
+def get(io_loop, *urls):
+    '''Fetch the URLs at the same time and decode their JSON responses.'''
+    @gen.coroutine
+    def fetch():
+        responses = yield [AsyncHTTPClient().fetch(url) for url in urls]
+        return [json.loads(r.body.decode('utf-8')) for r in responses]
+    return io_loop.run_sync(fetch)
+
+
+def test_server_timing():
+    assert app.server_timing([('render', 0.0012), ('took_fuzzy', 0.25)]) == \
+        'render;dur=1.20, took_fuzzy;dur=250.00'
+    assert app.server_timing([]) == ''
+
+
+def test_with_profile():
+    assert json.loads(queries.with_profile('{"size": 1}', False)) == \
+        {'size': 1, 'profile': True}
+    body = queries.msearch(['{}\n{"size": 1}\n', '{}\n{"size": 2}\n'])
+    lines = queries.with_profile(body, True).split('\n')
+    # The headers and the blank line at the end stay as they were
+    assert lines[::2] == body.split('\n')[::2]
+    assert lines[-2:] == ['', '']
+    assert [json.loads(line) for line in lines[1:-2:2]] == \
+        [{'size': 1, 'profile': True}, {'size': 2, 'profile': True}]
+
+
+def test_slow_query_log(api, io_loop, monkeypatch, caplog):
+    es, url = api
+    monkeypatch.setattr("geocoder.app.SLOW_QUERY_TIME", 1e-9)
+    monkeypatch.setattr("geocoder.app.SLOW_QUERY_PROFILE", True)
+    caplog.set_level(logging.WARNING, logger='geocoder.slow_queries')
+    get(io_loop, url + 'suggest/man')
+    # The profile is logged after the response
+    io_loop.run_sync(lambda: gen.sleep(0.1))
+    slow, profile = [r.getMessage() for r in caplog.records]
+    assert slow.startswith('/suggest/man took ')
+    assert 'took_fuzzy;dur=1.00' in slow
+    assert len(es['queries']) == 16
+    assert all(query.get('profile') for query in es['queries'][8:])
+    assert profile.startswith('Profile of _msearch: [{"shards": []}')
+
+
+def test_suggest_deadline(api, io_loop, monkeypatch):
+    es, url = api
+    monkeypatch.setattr("geocoder.app.SUGGEST_DEADLINE", 0.1)
+    es['fuzzy_delay'] = 0.3
+    late, = get(io_loop, url + 'suggest/man')
+    assert late['incomplete'] == ['fuzzy_streetnames']
+    assert late['fuzzy_streetnames'] == []
+    assert late['streetnames_fi'] == late['streetnames_sv'] == [{'Mannerheimintie': []}]
+    assert len(app.SUGGEST_CACHE) == 0
+    # Every subquery is sent in an _msearch of its own
+    assert len(es['queries']) == 8
+    es['fuzzy_delay'] = 0
+    complete, = get(io_loop, url + 'suggest/man?sources=fuzzy,streets')
+    assert 'incomplete' not in complete
+    assert complete['fuzzy_streetnames'] == [{'key': 'Mannerheimintie', 'doc_count': 1}]
+    assert len(app.SUGGEST_CACHE) == 1
+
+
+def test_suggest_with_bbox_is_not_narrowed(api, io_loop):
+    es, url = api
+    inside, = get(io_loop, url + 'suggest/ma?bbox=24,60,25,61')
+    assert inside['streetnames_fi'] == [{'Mannergeo': []}]
+    anywhere, = get(io_loop, url + 'suggest/man')
+    assert anywhere['streetnames_fi'] == [{'Mannerheimintie': []}]
+
+
+def test_suggest_shares_only_identical_queries(api, io_loop):
+    es, url = api
+    get(io_loop, url + 'suggest/ma')
+    es['fuzzy_delay'] = 0.2
+    # Both send only the fuzzy query, but only the latter narrows the
+    # streets and stops found for "ma"
+    fuzzy, narrowed = get(io_loop, url + 'suggest/man?sources=fuzzy', url + 'suggest/man')
+    assert fuzzy['streetnames_fi'] == []
+    assert narrowed['streetnames_fi'] == [{'Mannerheimintie': []}]
+    assert fuzzy['fuzzy_streetnames'] == narrowed['fuzzy_streetnames']
+    assert app.ES_QUERIES.coalesced == 0
+
+
+def test_suggest_tiers_share_only_identical_queries(api, io_loop, monkeypatch):
+    es, url = api
+    monkeypatch.setattr("geocoder.app.SUGGEST_TIERED", True)
+    es['delay'] = 0.2
+    first_tier = ','.join(queries.SUGGEST_TIERS[0])
+    # Both send the first tier, but only the latter goes on to the second
+    first, both = get(io_loop, url + 'suggest/man?sources=' + first_tier,
+                      url + 'suggest/man')
+    assert first['fuzzy_streetnames'] == []
+    assert both['fuzzy_streetnames'] == [{'key': 'Mannerheimintie', 'doc_count': 1}]
+    assert app.ES_QUERIES.coalesced == 0
@@ -0,0 +1,97 @@
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from geocoder.cache import ResponseCache, SingleFlight
+
+
+def run(coroutine):
+    loop = IOLoop()
+    try:
+        return loop.run_sync(coroutine)
+    finally:
+        loop.close()
+
+
+def test_lru_eviction():
+    cache = ResponseCache(size=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    # 'b' was the least recently used
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.stats()['hits'] == 3
+    assert cache.stats()['misses'] == 1
+
+
+def test_ttl_expiry():
+    now = [0]
+    cache = ResponseCache(size=10, ttl=5, clock=lambda: now[0])
+    cache.put('a', 1)
+    now[0] = 4
+    assert cache.get('a') == 1
+    now[0] = 5
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_flush_on_version_change():
+    cache = ResponseCache()
+    cache.set_version('2015-01-01')
+    cache.put('a', 1)
+    cache.set_version('2015-01-01')
+    assert cache.get('a') == 1
+    cache.set_version('2015-02-01')
+    assert cache.get('a') is None
+
+
+def test_single_flight():
+    flights = SingleFlight()
+    started = []
+
+    def start(abandoned):
+        started.append(Future())
+        return started[-1]
+
+    @gen.coroutine
+    def scenario():
+        first = flights.run('a', start)
+        assert flights.run('a', start) is first
+        assert flights.run('b', start) is not first
+        started[0].set_result(1)
+        # Let the loop run the done callbacks
+        yield gen.moment
+        # Finished work is not remembered
+        assert flights.run('a', start) is not first
+    run(scenario)
+    assert len(started) == 3
+    assert flights.stats() == {'in_flight': 2, 'started': 3, 'coalesced': 1,
+                               'abandoned': 0}
+
+
+def test_single_flight_abandoned_by_all_callers():
+    flights = SingleFlight()
+    abandoned = []
+
+    def start(future):
+        abandoned.append(future)
+        return Future()
+
+    @gen.coroutine
+    def scenario():
+        first, second = Future(), Future()
+        shared = flights.run('a', start, first)
+        assert flights.run('a', start, second) is shared
+        first.set_result(None)
+        yield gen.moment
+        assert not abandoned[0].done()
+        second.set_result(None)
+        yield gen.moment
+        assert abandoned[0].done()
+        # Later callers don't join the abandoned work
+        assert flights.run('a', start) is not shared
+    run(scenario)
+    assert flights.stats()['abandoned'] == 1
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import gzip
+import json
+
+import pytest
+from tornado.httputil import HTTPHeaders, HTTPServerRequest
+
+from geocoder.compression import accepts, transforms
+
+
+def request(accept_encoding):
+    return HTTPServerRequest(uri='/suggest/tie',
+                             headers=HTTPHeaders({'Accept-Encoding': accept_encoding}))
+
+
+def compress(accept_encoding):
+    body = json.dumps({'stops': [{'nameFi': 'Mannerheimintie %i' % i}
+                                 for i in range(100)]}).encode('utf-8')
+    headers = HTTPHeaders({'Content-Type': 'application/json',
+                           'Content-Length': str(len(body))})
+    for transform in transforms():
+        _, headers, body = transform(request(accept_encoding)).transform_first_chunk(
+            200, headers, body, True)
+    assert headers['Content-Length'] == str(len(body))
+    return headers, body
+
+
+def test_accepts():
+    assert accepts(request('gzip, deflate, br'), 'br')
+    assert not accepts(request('gzip, br;q=0'), 'br')
+    assert accepts(request('br; q=0.5'), 'br')
+    assert not accepts(request('gzip'), 'br')
+
+
+def test_gzip():
+    headers, body = compress('gzip')
+    assert headers['Content-Encoding'] == 'gzip'
+    assert headers['Vary'] == 'Accept-Encoding'
+    assert len(json.loads(gzip.decompress(body).decode('utf-8'))['stops']) == 100
+
+
+def test_brotli():
+    brotli = pytest.importorskip('brotli')
+    headers, body = compress('gzip, br')
+    assert headers['Content-Encoding'] == 'br'
+    assert headers['Vary'] == 'Accept-Encoding'
+    assert len(json.loads(brotli.decompress(body).decode('utf-8'))['stops']) == 100
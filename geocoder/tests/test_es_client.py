@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+import pytest
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+from tornado.web import Application, RequestHandler
+
+from geocoder.es_client import Cancelled, ESClient, unless_cancelled
+
+
+class FakeES(RequestHandler):
+    '''Answers every query after the node's delay, with the node's status.'''
+    def initialize(self, node):
+        self.node = node
+
+    @gen.coroutine
+    def post(self, path):
+        self.node['requests'] += 1
+        yield gen.sleep(self.node['delay'])
+        self.set_status(self.node['status'])
+        self.write({'node': self.node['name'], 'hits': {'hits': []}})
+
+    # The queries are sent as GET requests with a body
+    get = post
+
+
+@pytest.fixture
+def io_loop():
+    loop = IOLoop()
+    loop.make_current()
+    yield loop
+    loop.clear_current()
+    loop.close(all_fds=True)
+
+
+def fake_nodes(*names):
+    '''Start a fake ES node for each name, return their settings and URLs.'''
+    nodes, urls = [], []
+    for name in names:
+        node = {'name': name, 'delay': 0, 'status': 200, 'requests': 0}
+        sock, port = bind_unused_port()
+        server = HTTPServer(Application([(r"/reittiopas/(.*)", FakeES, {'node': node})]))
+        server.add_sockets([sock])
+        nodes.append(node)
+        urls.append('http://127.0.0.1:%i/reittiopas/' % port)
+    return nodes, urls
+
+
+def query(io_loop, client, n=1, hedge=False):
+    @gen.coroutine
+    def send():
+        responses = yield [client.fetch('_search', '{}', hedge=hedge, raise_error=False)
+                           for _ in range(n)]
+        return responses
+    return io_loop.run_sync(send)
+
+
+def test_round_robin(io_loop):
+    nodes, urls = fake_nodes('a', 'b', 'c')
+    client = ESClient(urls)
+    query(io_loop, client, 9)
+    assert [n['requests'] for n in nodes] == [3, 3, 3]
+
+
+def test_least_outstanding(io_loop):
+    nodes, urls = fake_nodes('slow', 'fast')
+    nodes[0]['delay'] = 0.5
+    client = ESClient(urls, routing='least-outstanding')
+
+    @gen.coroutine
+    def send():
+        # Native coroutines only start when scheduled
+        slow = [gen.convert_yielded(client.fetch('_search', '{}')) for _ in range(2)]
+        for _ in range(5):
+            yield client.fetch('_search', '{}')
+        yield slow
+    io_loop.run_sync(send)
+    # The slow node stays busy with its first query
+    assert nodes[0]['requests'] == 1
+    assert nodes[1]['requests'] == 6
+
+
+def test_failing_node_is_ejected(io_loop):
+    nodes, urls = fake_nodes('broken', 'ok')
+    nodes[0]['status'] = 503
+    now = [0.0]
+    client = ESClient(urls, max_failures=2, eject_time=10, clock=lambda: now[0])
+    responses = [query(io_loop, client)[0] for _ in range(8)]
+    assert [r.code for r in responses].count(503) == 2
+    assert client.stats()['nodes'][0]['ejected']
+    now[0] = 11.0
+    for _ in range(2):
+        query(io_loop, client)
+    assert nodes[0]['requests'] == 3
+
+
+def dead_url():
+    '''URL of a port that refuses connections.'''
+    sock, port = bind_unused_port()
+    sock.close()
+    return 'http://127.0.0.1:%i/reittiopas/' % port
+
+
+def test_dead_node_is_ejected(io_loop):
+    nodes, urls = fake_nodes('ok')
+    client = ESClient([dead_url()] + urls, max_failures=2)
+    responses = query(io_loop, client, 4)
+    assert sorted(r.code for r in responses) == [200, 200, 599, 599]
+    stats = client.stats()
+    assert stats['errors'] == stats['connection_errors'] == 2
+    assert stats['nodes'][0]['errors'] == 2
+    assert stats['nodes'][0]['ejected']
+    query(io_loop, client, 2)
+    assert nodes[0]['requests'] == 4
+
+
+def test_hedged_request_to_dead_node(io_loop):
+    nodes, urls = fake_nodes('ok')
+    # The first request goes to the second node
+    client = ESClient(urls + [dead_url()], hedge=True)
+    client.latencies.extend([0.1] * 30)
+    response, = query(io_loop, client, hedge=True)
+    assert response.code == 200
+    assert client.stats()['hedge_wins'] == 1
+
+
+def test_hedged_request(io_loop):
+    nodes, urls = fake_nodes('a', 'b')
+    client = ESClient(urls, hedge=True)
+    # Learn the normal latency
+    query(io_loop, client, 30)
+    nodes[0]['delay'] = 2
+    start = io_loop.time()
+    responses = query(io_loop, client, 2, hedge=True)
+    assert io_loop.time() - start < 1
+    assert all(b'"b"' in r.body for r in responses)
+    assert client.stats()['hedge_wins'] == 1
+
+
+def test_cancelled_request_is_not_hedged(io_loop):
+    nodes, urls = fake_nodes('a', 'b')
+    client = ESClient(urls, hedge=True)
+    # Hedge after 0.1 seconds
+    client.latencies.extend([0.1] * 30)
+    nodes[0]['delay'] = nodes[1]['delay'] = 0.5
+
+    @gen.coroutine
+    def send():
+        cancelled = Future()
+        sent = unless_cancelled(client.fetch('_search', '{}', hedge=True,
+                                             cancelled=cancelled), cancelled)
+        yield gen.sleep(0.05)
+        cancelled.set_result(None)
+        with pytest.raises(Cancelled):
+            yield sent
+        with pytest.raises(Cancelled):
+            yield client.fetch('_search', '{}', cancelled=cancelled)
+        # Let the request already sent finish, after the hedging delay
+        yield gen.sleep(0.6)
+    io_loop.run_sync(send)
+    assert nodes[0]['requests'] + nodes[1]['requests'] == 1
+    assert client.stats()['hedged'] == 0
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+from math import cos, radians
+import random
+
+import pytest
+from shapely.geometry import LineString
+
+from geocoder.address_index import AddressIndex
+from geocoder.municipality_index import MunicipalityIndex
+from geocoder.reverse_index import NearestAddressIndex
+from geocoder.road_index import RoadIndex
+from geocoder.suggest_index import SubstringIndex, SuggestIndex, TypoIndex, edit_distance
+
+
+def hri_address(street, number, number2=None, divisor='', location=(24.9, 60.2)):
+    return {'kaupunki': 'Vantaa', 'staden': 'Vanda',
+            'katunimi': street, 'gatan': street + 'vägen',
+            'osoitenumero': number,
+            'osoitenumero2': number if number2 is None else number2,
+            'kiinteiston_jakokirjain': divisor,
+            'left_side': number % 2 == 0,
+            'location': location}
+
+
+def address_index():
+    index = AddressIndex()
+    for address in [hri_address('Virsutie', 4, 6),
+                    hri_address('Virsutie', 1),
+                    hri_address('Virsutie', 8, divisor='a'),
+                    hri_address('Virsutie', 8, divisor='b')]:
+        index.add(address)
+    index.add_osm({'municipality': 'Vantaa', 'street': 'Virsutie', 'number': '3',
+                   'unit': None, 'location': (24.9, 60.2)})
+    index.finalize()
+    return index
+
+
+def test_address_range_and_side():
+    index = address_index()
+    hri, osm = index.address('vanda', 'VIRSUTIEVÄGEN', '6', '6', '')
+    assert [(a['osoitenumero'], a['osoitenumero2']) for a in hri] == [(4, 6)]
+    # 5 would be inside the range 4-6, but on the other side of the road
+    assert index.address('Vantaa', 'Virsutie', '5', '5', '') == ([], [])
+
+
+def test_address_divisor_and_osm():
+    index = address_index()
+    hri, osm = index.address('Vantaa', 'Virsutie', '8B', '8', 'B')
+    assert [a['kiinteiston_jakokirjain'] for a in hri] == ['b']
+    hri, osm = index.address('Vantaa', 'virsutie', '3', '3', '')
+    assert hri == [] and len(osm) == 1
+
+
+def test_street():
+    hri, osm = address_index().street('Vantaa', 'Virsutie')
+    assert [a['osoitenumero'] for a in hri] == [1, 4, 8, 8]
+    assert len(osm) == 1
+
+
+def test_street_is_capped_like_es():
+    index = AddressIndex()
+    for number in range(1, 13):
+        index.add(hri_address('Virsutie', number))
+    index.finalize()
+    hri, osm = index.street('Vantaa', 'Virsutie')
+    assert [a['osoitenumero'] for a in hri] == list(range(1, 11))
+
+
+def test_nearest_address():
+    addresses = [hri_address('Virsutie', n, location=(24.9 + n * 0.001, 60.2))
+                 for n in range(1, 50)]
+    index = NearestAddressIndex(addresses)
+    assert index.nearest(60.2, 24.9 + 10.2 * 0.001)['osoitenumero'] == 10
+    # Far away from every address, but something is still the nearest
+    assert index.nearest(65.0, 27.0)['osoitenumero'] == 49
+    assert NearestAddressIndex([]).nearest(60.2, 24.9) is None
+
+
+def test_nearest_address_matches_brute_force():
+    random.seed(0)
+    addresses = [hri_address('Virsutie', 1, location=(random.uniform(24.6, 25.2),
+                                                      random.uniform(60.1, 60.4)))
+                 for _ in range(2000)]
+    index = NearestAddressIndex(addresses)
+    scale = cos(radians(60.25))
+    for _ in range(100):
+        lat, lon = random.uniform(60.0, 60.5), random.uniform(24.5, 25.3)
+        expected = min(addresses, key=lambda a: ((a['location'][0] - lon) * scale) ** 2 +
+                       (a['location'][1] - lat) ** 2)
+        assert index.nearest(lat, lon) is expected
+
+
+def municipality(name, x0, y0, x1, y1):
+    return {'nimi': name, 'namn': name,
+            'boundaries': {'type': 'MultiPolygon',
+                           'coordinates': [[[[x0, y0], [x1, y0], [x1, y1],
+                                             [x0, y1], [x0, y0]]]]}}
+
+
+def test_municipality_lookup():
+    for grid_size in (None, 0.1):
+        index = MunicipalityIndex([municipality('Espoo', 24.5, 60.1, 24.85, 60.35),
+                                   municipality('Helsinki', 24.85, 60.1, 25.25, 60.3)],
+                                  grid_size=grid_size)
+        assert index.find(60.2, 24.7)['nimi'] == 'Espoo'
+        # Next to the border, in a raster cell shared by both
+        assert index.find(60.2, 24.86)['nimi'] == 'Helsinki'
+        assert index.find(60.32, 25.0) is None
+    assert index.grid
+
+
+def road(name, coordinates, **ranges):
+    document = {'nimi': name, 'namn': name,
+                'location': {'type': 'LineString', 'coordinates': coordinates}}
+    document.update(ranges)
+    return document
+
+
+def test_road_interpolation():
+    index = RoadIndex()
+    index.add(road('Mannerheimintie', [[24.0, 60.0], [24.0, 60.1], [24.1, 60.1]],
+                   min_vasen=2, max_vasen=10, min_oikea=[1], max_oikea=[9]))
+    index.add(road('Mannerheimintie', [[24.1, 60.1], [24.2, 60.1]],
+                   min_vasen=12, max_vasen=12))
+    index.add({'nimi': 'Mannerheimintie', 'osoitenumero': '3',
+               'location': {'type': 'Point', 'coordinates': [24.0, 60.0]}})
+    index.finalize()
+    line = LineString([[24.0, 60.0], [24.0, 60.1], [24.1, 60.1]])
+    for number in (2, 4, 9, 10):
+        fraction = (number - (number % 2 == 0 and 2 or 1)) / 8
+        expected = line.interpolate(fraction, normalized=True).coords[0]
+        assert index.interpolate('MANNERHEIMINTIE', number) == \
+            pytest.approx(list(expected))
+    # A single number range is placed in the middle of the segment
+    assert index.interpolate('Mannerheimintie', 12) == pytest.approx([24.15, 60.1])
+    assert index.interpolate('Mannerheimintie', 11) is None
+    assert index.interpolate('Foo', 2) is None
+
+
+def test_nearest_addresses_batch():
+    random.seed(1)
+    addresses = [hri_address('Virsutie', 1, location=(random.uniform(24.6, 25.2),
+                                                      random.uniform(60.1, 60.4)))
+                 for _ in range(2000)]
+    index = NearestAddressIndex(addresses)
+    lats = [random.uniform(60.0, 60.5) for _ in range(300)] + [65.0]
+    lons = [random.uniform(24.5, 25.3) for _ in range(300)] + [27.0]
+    assert index.nearest_indexes(lats, lons).tolist() == \
+        [index.nearest_index(lat, lon) for lat, lon in zip(lats, lons)]
+
+
+def test_nearest_addresses_batch_in_chunks(monkeypatch):
+    monkeypatch.setattr("geocoder.reverse_index.CHUNK_SIZE", 7)
+    random.seed(2)
+    addresses = [hri_address('Virsutie', 1, location=(random.uniform(24.9, 24.92),
+                                                      random.uniform(60.2, 60.21)))
+                 for _ in range(200)]
+    index = NearestAddressIndex(addresses)
+    # Most of the points fall in the same few cells
+    lats = [random.uniform(60.2, 60.21) for _ in range(100)]
+    lons = [random.uniform(24.9, 24.92) for _ in range(100)]
+    assert index.nearest_indexes(lats, lons).tolist() == \
+        [index.nearest_index(lat, lon) for lat, lon in zip(lats, lons)]
+
+
+def test_municipalities_batch():
+    index = MunicipalityIndex([municipality('Espoo', 24.5, 60.1, 24.85, 60.35),
+                               municipality('Helsinki', 24.85, 60.1, 25.25, 60.3)])
+    assert index.find_indexes([60.2, 60.2, 60.32], [24.7, 24.86, 25.0]).tolist() == \
+        [0, 1, -1]
+
+
+def test_municipalities_batch_on_borders():
+    # Outer borders of both, and the border between them
+    lats = [60.35, 60.1, 60.2, 60.1]
+    lons = [24.6, 25.0, 24.85, 24.85]
+    for grid_size in (None, 0.1):
+        index = MunicipalityIndex([municipality('Espoo', 24.5, 60.1, 24.85, 60.35),
+                                   municipality('Helsinki', 24.85, 60.1, 25.25, 60.3)],
+                                  grid_size=grid_size)
+        assert index.find_indexes(lats, lons).tolist() == \
+            [index.find_index(lat, lon) for lat, lon in zip(lats, lons)] == [0, 1, 0, 0]
+
+
+def test_substring_index():
+    strings = ['mannerheimintie', 'manttaalitie', 'ann', '', 'tie']
+    index = SubstringIndex(strings)
+    for term in ('ann', 'tie', 'm', 'mannerheimintie', 'x', 'iet', ''):
+        assert index.find(term) == [i for i, s in enumerate(strings) if term in s]
+
+
+def test_suggest_index():
+    index = SuggestIndex()
+    for n in range(3):
+        index.add(hri_address('Mannerheimintie', n))
+    index.add(dict(hri_address('Mannerheimintie', 1), kaupunki='Espoo', staden='Esbo'))
+    index.add(hri_address('Virsutie', 1))
+    index.add_stop({'_id': '1', '_source': {'NAME_FI': 'Mannerheimintie 5',
+                                            'STOP_CODE': 'H1234',
+                                            'MUNICIPALITY_NAME': 'Helsinki'}})
+    index.finalize()
+    fi, sv, name_fi = index.suggest('NERHEIM')[:3]
+    streets = fi['aggregations']['streets']['buckets']
+    assert [(b['key'], b['doc_count']) for b in streets] == [('Mannerheimintie', 4)]
+    assert streets[0]['cities']['buckets'] == [{'key': 'Vantaa', 'doc_count': 3},
+                                               {'key': 'Espoo', 'doc_count': 1}]
+    assert sv['aggregations']['streets']['buckets'][0]['key'] == 'Mannerheimintievägen'
+    assert name_fi['hits']['total'] == 1
+    fi, sv, name_fi = index.suggest('nerheim', ['ESBO'])[:3]
+    assert fi['aggregations']['streets']['buckets'][0]['cities']['buckets'] == \
+        [{'key': 'Espoo', 'doc_count': 1}]
+    assert name_fi['hits']['hits'] == []
+    assert index.suggest('h12')[5]['hits']['hits'][0]['_id'] == '1'
+    fuzzy = index.suggest('Mannehreimintievägen')[7]['aggregations']['streets']['buckets']
+    assert fuzzy == [{'key': 'Mannerheimintievägen', 'doc_count': 4}]
+
+
+def test_typo_index_matches_brute_force():
+    random.seed(0)
+    index = TypoIndex()
+    for _ in range(100):
+        name = ''.join(random.choice('aeiknrst') for _ in range(random.randint(1, 12)))
+        index.add({'katunimi': name, 'gatan': name + 'vägen'})
+    index.finalize()
+    for _ in range(100):
+        term = ''.join(random.choice('aeiknrst') for _ in range(random.randint(1, 12)))
+        distance = 0 if len(term) <= 2 else 1 if len(term) <= 5 else 2
+        expected = [i for i, name in enumerate(index.lowered)
+                    if edit_distance(name, term) <= distance]
+        assert index.find(term) == expected
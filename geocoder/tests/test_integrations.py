@@ -1,4 +1,4 @@
-from json import loads
+from json import dumps, loads
 
 import pytest
 import requests
@@ -75,6 +75,38 @@ def test_not_existing_address():
     assert r.status_code == 404
 
 
+def test_batch_address():
+    r = requests.post('http://localhost:8888/batch/address', data=dumps({'addresses': [
+        {'city': 'Helsinki', 'streetname': 'Ida Aalbergin tie', 'streetnumber': '9'},
+        {'city': 'Helsinki', 'streetname': 'Mannerheimintie', 'streetnumber': '9999'},
+        {'city': 'Vantaa', 'streetname': 'Virsutie', 'streetnumber': '5'}]}))
+    assert r.status_code == 200
+    results = loads(r.text)['results']
+    assert [x['status'] for x in results] == [200, 404, 200]
+    assert results[0]['results'][0]['location'] == [24.896918441103022, 60.22986936848425]
+    assert len(results[2]['results']) == 1
+
+
+def test_batch_address_invalid_streetnumber():
+    r = requests.post('http://localhost:8888/batch/address', data=dumps({'addresses': [
+        {'city': 'Helsinki', 'streetname': 'Ida Aalbergin tie', 'streetnumber': '9'},
+        {'city': 'Helsinki', 'streetname': 'Mannerheimintie', 'streetnumber': '7"'},
+        {'city': 'Vantaa', 'streetname': 'Virsutie',
+         'streetnumber': '5\n{"type": "address"}\n{"query": {"match_all": {}}}\n'},
+        {'city': 'Vantaa', 'streetname': 'Virsutie', 'streetnumber': '5\n'},
+        {'city': 'Vantaa', 'streetname': 'Virsutie', 'streetnumber': '\u0661\u0662'},
+        {'city': 'Vantaa', 'streetname': 'Virsutie', 'streetnumber': '1\u0661'}]}))
+    assert r.status_code == 200
+    results = loads(r.text)['results']
+    assert [x['status'] for x in results] == [200, 400, 400, 400, 400, 400]
+
+
+def test_batch_address_too_many():
+    r = requests.post('http://localhost:8888/batch/address', data=dumps({'addresses': [
+        {'city': 'Helsinki', 'streetname': 'Mannerheimintie', 'streetnumber': '1'}] * 1001}))
+    assert r.status_code == 400
+
+
 def test_street():
     r = requests.get('http://localhost:8888/street/Helsinki/Mannerheimintie')
     assert r.status_code == 200
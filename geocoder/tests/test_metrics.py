@@ -0,0 +1,25 @@
+from geocoder.metrics import Counter, Histogram
+
+
+def test_counter():
+    counter = Counter('requests_total', "Requests.", ('handler', 'status'))
+    counter.inc('SuggestHandler', '200')
+    counter.inc('SuggestHandler', '200')
+    counter.inc('Reverse"Handler', '404')
+    assert counter.render().splitlines() == [
+        '# HELP requests_total Requests.',
+        '# TYPE requests_total counter',
+        'requests_total{handler="Reverse\\"Handler",status="404"} 1.0',
+        'requests_total{handler="SuggestHandler",status="200"} 2.0']
+
+
+def test_histogram():
+    histogram = Histogram('time_seconds', "Time.", ('handler',), buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value, 'SuggestHandler')
+    assert histogram.render().splitlines()[2:] == [
+        'time_seconds_bucket{handler="SuggestHandler",le="0.1"} 2.0',
+        'time_seconds_bucket{handler="SuggestHandler",le="1.0"} 3.0',
+        'time_seconds_bucket{handler="SuggestHandler",le="+Inf"} 4.0',
+        'time_seconds_sum{handler="SuggestHandler"} 3.65',
+        'time_seconds_count{handler="SuggestHandler"} 4.0']
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import time
+
+import pytest
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from geocoder.metrics import Histogram
+from geocoder.offload import LagMonitor, Offloader
+
+
+def where():
+    return os.getpid(), threading.get_ident()
+
+
+def run(coroutine):
+    loop = IOLoop()
+    try:
+        return loop.run_sync(coroutine)
+    finally:
+        loop.close()
+
+
+@pytest.mark.parametrize('kind', ['thread', 'process'])
+def test_large_payloads_are_offloaded(kind):
+    offloader = Offloader(kind, 1, min_size=100)
+    here = where()
+
+    @gen.coroutine
+    def scenario():
+        small = yield offloader.run(99, where)
+        large = yield offloader.run(100, where)
+        return small, large
+    try:
+        small, large = run(scenario)
+    finally:
+        offloader.configure()
+    assert small == here
+    assert large != here
+    assert (large[0] != here[0]) == (kind == 'process')
+
+
+def test_lag_monitor():
+    histogram = Histogram('lag', "Lag")
+    monitor = LagMonitor(histogram, interval=0.01)
+
+    @gen.coroutine
+    def scenario():
+        monitor.start()
+        yield gen.sleep(0.02)
+        IOLoop.current().add_callback(time.sleep, 0.1)
+        yield gen.sleep(0.15)
+    run(scenario)
+    assert monitor.max_lag >= 0.05
+    assert histogram.series[()][2] >= 2
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import json
+
+from geocoder import queries
+from geocoder.suggest import PrefixCandidates, empty_response, section, suggestion_count
+
+
+def streets(*names):
+    return {'aggregations': {'streets': {'buckets': [
+        {'key': name, 'doc_count': 1, 'cities': {'buckets': []}} for name in names]}}}
+
+
+def stops(field, *names):
+    return {'hits': {'total': len(names), 'hits': [
+        {'_id': name, '_source': {field: name}} for name in names]}}
+
+
+def responses():
+    return [streets('Mannerheimintie', 'Manttaalitie'),
+            streets('Mannerheimvägen'),
+            stops('NAME_FI', 'Mannerheimintie 5', 'Mankkaa'),
+            stops('NAME_SV'),
+            stops('COMMENTS'),
+            stops('STOP_CODE'),
+            stops('ADDRESS')]
+
+
+def test_narrow_from_prefix():
+    candidates = PrefixCandidates()
+    candidates.add('Man', (), responses())
+    narrowed = candidates.find('mann', ())
+    assert [b['key'] for b in narrowed[0]['aggregations']['streets']['buckets']] == \
+        ['Mannerheimintie']
+    assert [h['_id'] for h in narrowed[2]['hits']['hits']] == ['Mannerheimintie 5']
+    # The narrowed result can itself be narrowed further
+    assert candidates.find('mannerheimv', ())[1]['aggregations']['streets']['buckets']
+
+
+def test_no_narrowing_from_truncated_or_other_cities():
+    candidates = PrefixCandidates()
+    truncated = responses()
+    truncated[2]['hits']['total'] = 25
+    candidates.add('man', (), truncated)
+    assert candidates.find('mann', ()) is None
+    candidates.add('man', ('espoo',), responses())
+    assert candidates.find('mann', ()) is None
+    assert candidates.find('mann', ('espoo',)) is not None
+
+
+def test_tiers():
+    first = queries.suggest('Mann', ['Espoo'], subqueries=queries.SUGGEST_TIERS[0])
+    lines = [json.loads(line) for line in first.splitlines() if line]
+    assert len(lines) == 2 * len(queries.SUGGEST_TIERS[0])
+    assert set(sum(queries.SUGGEST_TIERS, ())) == set(queries.SUGGEST_NAMES)
+    found = dict(zip(queries.SUGGEST_NAMES, responses()))
+    # The two stops and the two Finnish street names
+    assert suggestion_count(found) == 4
+    found['stops_name_sv'] = stops('NAME_SV', 'Mankkaa')
+    found['fuzzy'] = empty_response('fuzzy')
+    assert suggestion_count(found) == 4
+
+
+def test_sections():
+    assert {section(name) for name in queries.SUGGEST_NAMES} == \
+        {'streetnames_fi', 'streetnames_sv', 'stops', 'fuzzy_streetnames'}
+
+
+def test_location_filter():
+    geo = queries.SUGGEST_GEO.render(bbox=(24.8, 60.1, 25.0, 60.3))
+    subqueries = queries.SUGGEST_SOURCES['stops'] + ('fuzzy',)
+    body = queries.suggest('Mann', ['Espoo'], subqueries=subqueries, geo=geo)
+    lines = [json.loads(line) for line in body.splitlines() if line]
+    assert len(lines) == 2 * len(subqueries)
+    for query in lines[1::2]:
+        bbox = json.dumps(query['query']['filtered']['filter'])
+        assert '"top_left": {"lat": 60.3, "lon": 24.8}' in bbox
@@ -6,6 +6,8 @@ from urllib3.exceptions import ProtocolError
 
 import pyelasticsearch
 
+from geocoder.ngram import NGRAM_MAX, NGRAM_MIN
+
 INDEX = 'reittiopas'
 ES = pyelasticsearch.ElasticSearch('http://localhost:9200')
 
@@ -34,10 +36,20 @@ def prepare_es(mappings):
                     "myAnalyzer": {
                         "type": "custom",
                         "tokenizer": "keyword",
-                        "filter": ["myLowerCaseFilter"]}},
+                        "filter": ["myLowerCaseFilter"]},
+                    # Every substring of the whole lowercased value,
+                    # for infix search without leading wildcards
+                    "infixAnalyzer": {
+                        "type": "custom",
+                        "tokenizer": "keyword",
+                        "filter": ["myLowerCaseFilter", "infixNGramFilter"]}},
                 "filter": {
                     "myLowerCaseFilter": {
-                        "type": "lowercase"}}}})
+                        "type": "lowercase"},
+                    "infixNGramFilter": {
+                        "type": "nGram",
+                        "min_gram": NGRAM_MIN,
+                        "max_gram": NGRAM_MAX}}}})
     except pyelasticsearch.exceptions.IndexAlreadyExistsError:
         pass
     except ProtocolError:
@@ -53,6 +65,12 @@ def prepare_es(mappings):
         ES.put_mapping(index=INDEX, doc_type=doctype, mapping=mapping)
 
 
+# Subfield for infix search with the suggest endpoint
+NGRAM_FIELD = {"type": "string",
+               "analyzer": "infixAnalyzer",
+               "search_analyzer": "myAnalyzer"}
+
+
 _source = osr.SpatialReference()
 _source.ImportFromEPSG(3067)  # ETRS89 / ETRS-TM35FIN
 _target = osr.SpatialReference()
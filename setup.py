@@ -18,8 +18,9 @@ requirements = [
     'imposm.parser', 'rtree',  # For OpenStreetMap
     'ijson',  # For capital area service map
     'pyshp',  # For lipas
-    'shapely',  # For NLS addresses
+    'shapely>=2',  # For NLS addresses and the in-memory indexes
     'tornado', 'jinja2',  # For the web API
+    'numpy',  # For the in-memory indexes of the web API
     'sphinx', 'sphinxcontrib-httpdomain'
 ]
 
@@ -61,7 +62,7 @@ setup(
         # Specify the Python versions you support here. In particular, ensure
         # that you indicate whether you support Python 2, Python 3 or both.
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3.7',
 
         'Topic :: Scientific/Engineering :: GIS',
         'Topic :: Software Development :: Pre-processors',
@@ -72,6 +73,8 @@ setup(
     # packages=find_packages(exclude=['contrib', 'docs', 'tests*']),
     packages=['geocoder'],
 
+    # Shapely 2 needs Python 3.7 or later
+    python_requires='>=3.7',
 
     install_requires=requirements,
     setup_requires=requirements,
@@ -83,6 +86,10 @@ setup(
     extras_require={
         # 'dev': ['check-manifest'],
         # 'test': ['coverage'],
+        # Brotli compression of the API responses
+        'brotli': ['brotli'],
+        # Faster event loop for the web API
+        'uvloop': ['uvloop'],
     },
 
     # If there are data files included in your packages that need to be